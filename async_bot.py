@@ -0,0 +1,362 @@
+import os
+import time
+import random
+import asyncio
+import functools
+import startup
+from collections import defaultdict, Counter
+from types import SimpleNamespace
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.types import CallbackQuery
+from transcribe import iter_transcription
+from parse import parse_message
+
+from movies import get_movies, get_info
+from session import SessionStore, update_chat_id
+from inference import InferenceExecutor, Busy
+from markups import (status_message, movie_description, thoughts_message, category_markup, tag_markup,
+                     film_tv_markup, check_movie_markup, write_movie_markup, voice_markup, thoughts_markup)
+
+
+# The asyncio runtime: Telegram calls go through aiohttp on the event loop, blocking work
+# (embeddings, punctuation, speech recognition, TMDb and Google Sheets) runs in the lanes
+# of an InferenceExecutor and photos go to the OCRService worker. `services` holds tm, punct,
+# ocr, sheet_writer, ms, posters and optionally a speech recognizer, so a load test can pass stubs.
+class AsyncNoteBot(AsyncTeleBot):
+    def __init__(self, api_token, note_db_path, admin_chat_id, services, executor,
+                 session_ttl=86400., max_sessions=1000, session_path=None,
+                 stream_edit_interval=1.5, transcribe_workers=4):
+        super().__init__(api_token)
+        self.db_path = note_db_path
+        self.admin_chat_id = admin_chat_id
+        self.lang = "ru-RU"
+        self.services, self.executor = services, executor
+        self.sessions = SessionStore(session_ttl, max_sessions, session_path)
+        self.chat_locks, self.chat_waiting = defaultdict(asyncio.Lock), Counter()
+        self.prefetching = set()
+        self.stream_edit_interval, self.transcribe_workers = stream_edit_interval, transcribe_workers
+
+        self.register_callback_query_handler(self.guarded(self.callback_query), func=lambda call: True)
+        self.register_message_handler(self.guarded(self.start_message), commands=["start"])
+        self.register_message_handler(self.guarded(self.handle_voice), content_types=["voice"])
+        self.register_message_handler(self.guarded(self.handle_image), content_types=["photo"])
+        self.register_message_handler(self.guarded(self.handle_text), content_types=["text"])
+
+    def guarded(self, handler):
+        # a full inference lane turns into a reply instead of a silently dropped update
+        @functools.wraps(handler)
+        async def run(update):
+            try:
+                await handler(update)
+            except Busy as e:
+                chat_id = update.message.chat.id if isinstance(update, CallbackQuery) else update.chat.id
+                print(f"### {e} lane is full, update of chat {chat_id} dropped ###")
+                await self.send_message(chat_id, "Бот перегружен, попробуйте позже")
+        return run
+
+    async def process_new_updates(self, updates):
+        # updates of one chat are handled in order, different chats concurrently
+        for update in updates:
+            if update.message is not None and update.message.photo:
+                # photos of an album arrive together, recognizing them ahead lets the ocr worker batch them
+                task = asyncio.create_task(self.prefetch_photo(update.message.photo[-1]))
+                self.prefetching.add(task)
+                task.add_done_callback(self.prefetching.discard)
+        await asyncio.gather(*(self.process_chat_update(update_chat_id(u), u) for u in updates))
+
+    async def process_chat_update(self, chat_id, update):
+        if chat_id is None:
+            await super().process_new_updates([update])
+            return
+        # asyncio.Lock wakes waiters in order, so updates keep their order within a chat
+        lock, self.chat_waiting[chat_id] = self.chat_locks[chat_id], self.chat_waiting[chat_id] + 1
+        try:
+            async with lock:
+                session = await self.stored(self.sessions.acquire, chat_id)
+                try:
+                    await super().process_new_updates([update])
+                finally:
+                    await self.stored(self.sessions.release, session)
+            startup.mark_first_reply()
+        finally:
+            self.chat_waiting[chat_id] -= 1
+            if not self.chat_waiting[chat_id]:
+                del self.chat_waiting[chat_id], self.chat_locks[chat_id]
+
+    async def stored(self, fn, *args):
+        # persisted sessions are read and written in SQLite, off the loop; not through a lane,
+        # a release turned away as busy would leave the session pinned
+        if self.sessions.conn is None:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    def session(self, chat_id):
+        # handlers run between acquire and release, the session is in memory
+        return self.sessions.get(chat_id)
+
+    async def recognize_photo(self, photo):
+        ocr = self.services.ocr
+        future = ocr.find(photo.file_unique_id)
+        if future is None:
+            file = await self.get_file(photo.file_id)
+            image = await self.download_file(file.file_path)
+            # decoding and downscaling happen in submit, off the event loop
+            future = await self.executor.run('io', ocr.submit, photo.file_unique_id, lambda: image)
+        return await asyncio.wrap_future(future)
+
+    async def prefetch_photo(self, photo):
+        try:
+            await self.recognize_photo(photo)
+        except Exception as e:
+            # the handler asks again and reports the error
+            print(f"### Prefetching photo {photo.file_unique_id} failed: {e} ###")
+
+    async def transcribe_message(self, session, message, progress_message_id=None):
+        session.tags = []
+        file_info = await self.get_file(message.voice.file_id)
+        voice_file = await self.download_file(file_info.file_path)
+
+        raw, punctuated, last_edit = [], [], time.monotonic()
+        chunks = self.executor.iterate('io', iter_transcription, voice_file, self.lang,
+                                       recognizer=getattr(self.services, 'recognizer', None), workers=self.transcribe_workers)
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            raw.append(chunk)
+            punctuated.append(await self.executor.run('punct', self.services.punct.apply, chunk))
+            if progress_message_id is not None and time.monotonic() - last_edit > self.stream_edit_interval:
+                await self.edit_text(session, progress_message_id, ' '.join(punctuated) + ' …')
+                last_edit = time.monotonic()
+        return ' '.join(raw), ' '.join(punctuated)
+
+    async def edit_text(self, session, message_id, text, reply_markup=None):
+        try:
+            await self.edit_message_text(text, session.chat_id, message_id, reply_markup=reply_markup)
+        except ApiTelegramException as e:
+            print(f'Cannot edit message {message_id}: {e}')
+
+    async def save_text(self, session):
+        note_text, note_name = parse_message(session.text, session.tags, session.links)
+        sv_path = os.path.join(self.db_path, f"voice/{note_name}.md")
+
+        with open(sv_path, "w") as f:
+            f.write(note_text)
+        await self.clear(session)
+        self.services.tm.watcher.notify(sv_path)
+
+    async def handle_expense(self, session, amount):
+        session.amount = amount
+        session.wait_value = 'comment'
+        # the first access loads SheetWriter, which reads the sheet, and later ones may start a refresh
+        categories = await self.executor.run('io', lambda: self.services.sheet_writer.categories)
+        msg = await self.send_message(session.chat_id, f"Сумма: {amount}\nУкажите категорию",
+                                      reply_markup=category_markup(categories))
+        return msg.message_id
+
+    async def clear(self, session):
+        session.reset()
+        print(f'Deleting {session.to_delete}')
+        for msg_id in session.to_delete:
+            try:
+                await self.delete_message(session.chat_id, msg_id)
+            except Exception:
+                print(f'Cannot delete message {msg_id}')
+        session.to_delete = []
+
+    async def show_movie(self, s):
+        # the next candidates are prepared while this one is looked at
+        movie, posters = s.movies[0], self.services.posters
+        posters.prefetch(s.movies[1:], s.type)
+        info = s.info = await self.executor.run('io', get_info, movie, type=s.type)
+        path, description = movie.pop('poster_path', None), movie_description(info, movie)
+        if path is None:
+            msg = await self.send_message(s.chat_id, description, reply_markup=check_movie_markup())
+        else:
+            try:
+                msg = await self.send_photo(s.chat_id, posters.photo(path), caption=description, reply_markup=check_movie_markup())
+            except ApiTelegramException:
+                # telegram could not download the url, the poster is uploaded instead
+                poster = await self.executor.run('io', posters.fetch, path)
+                msg = await self.send_photo(s.chat_id, poster, caption=description, reply_markup=check_movie_markup())
+            posters.sent(path, msg)
+        s.to_delete.append(msg.message_id)
+
+    async def find_movies(self, s, call, type):
+        s.type = type
+        s.movies = await self.executor.run('io', get_movies, s.text, year=s.year, language='ru', type=type)
+        if len(s.movies) == 0:
+            await self.send_message(s.chat_id, "Фильм не найден :(")
+            await self.clear(s)
+            await self.answer_callback_query(call.id, "Film search ended")
+        else:
+            await self.show_movie(s)
+
+    async def callback_query(self, call):
+        s = self.session(call.message.chat.id)
+        tm, ms = self.services.tm, self.services.ms
+        if call.data == "save_note":
+            if str(s.chat_id) == str(self.admin_chat_id):
+                await self.save_text(s)
+                await self.answer_callback_query(call.id, "Note saved")
+            else:
+                await self.answer_callback_query(call.id, "Not available")
+                await self.send_message(self.admin_chat_id, f"{s.chat_id} пытается сохранить тебе заметку!")
+
+        elif call.data == "find_film":
+            msg = await self.send_message(s.chat_id, "Укажи год, если возможно.", reply_markup=film_tv_markup())
+            s.to_delete.append(msg.message_id)
+            s.year = None
+            s.wait_value = 'year'
+        elif call.data == "save_movie":
+            await self.find_movies(s, call, 'movie')
+        elif call.data == "save_tv":
+            await self.find_movies(s, call, 'tv')
+        elif call.data == "another_movie":
+            await self.delete_message(s.chat_id, s.to_delete[-1])
+            s.movies = s.movies[1:]
+            if len(s.movies) > 0:
+                await self.show_movie(s)
+            else:
+                await self.send_message(s.chat_id, "Фильм не найден :(")
+                await self.clear(s)
+                await self.answer_callback_query(call.id, "Film search ended")
+        elif call.data == "get_rating":
+            msg = await self.send_message(s.chat_id, "Введи оценку от 1 до 10", reply_markup=write_movie_markup())
+            s.to_delete.append(msg.message_id)
+            s.wait_value = 'rating'
+        elif call.data == "write_movie":
+            if str(s.chat_id) == str(self.admin_chat_id):
+                await self.executor.run('io', ms.save, s.movies[0], s.rating, s.type, s.comment, info=s.info)
+            await self.clear(s)
+            await self.answer_callback_query(call.id, "Film saved")
+        elif call.data == "to_watchlist":
+            if str(s.chat_id) == str(self.admin_chat_id):
+                await self.executor.run('io', ms.save, s.movies[0], s.rating, s.type, sheet=1, info=s.info)
+                await self.answer_callback_query(call.id, "Film added to watchlist")
+            await self.clear(s)
+        elif call.data == "hashtag":
+            await self.answer_callback_query(call.id)
+            s.wait_value = "tag"
+            s.suggested_tags = await self.executor.run('embed', tm.suggest_tags, s.text, s.tags)
+            msg = await self.send_message(s.chat_id, "Введи название тега", reply_markup=tag_markup(s.suggested_tags))
+            s.to_delete.append(msg.message_id)
+        elif call.data.startswith("add_tag_"):
+            s.tags.append(call.data.split('add_tag_')[1])
+        elif call.data.startswith("add_link_"):
+            link = int(call.data.split('add_link_')[1])
+            s.links.append(s.nearest.name.values[link])
+        elif call.data == "get_thoughts":
+            s.nearest = await self.executor.run('embed', tm.get_nearest, s.text, k=25)
+            msg = await self.send_message(s.chat_id, thoughts_message(s.nearest[:5]), reply_markup=thoughts_markup())
+            s.to_delete.append(msg.message_id)
+        elif call.data == "next_thoughts":
+            s.nearest = s.nearest[5:]
+            if len(s.nearest) == 0:
+                msg = await self.send_message(s.chat_id, "Конец")
+                s.to_delete.append(msg.message_id)
+                await self.clear(s)
+            else:
+                await self.delete_message(s.chat_id, s.to_delete[-1])
+                msg = await self.send_message(s.chat_id, thoughts_message(s.nearest[:5]), reply_markup=thoughts_markup())
+                s.to_delete.append(msg.message_id)
+
+        elif call.data.startswith("category_"):
+            category = call.data.split('category_')[1]
+            await self.executor.run('io', self.services.sheet_writer.write_to_gsheet, s.amount, category, s.comment)
+            await self.answer_callback_query(call.id, "Expense saved")
+            await self.clear(s)
+        elif call.data == "clear":
+            await self.clear(s)
+
+    async def start_message(self, message):
+        s = self.session(message.chat.id)
+        s.text = ""
+        await self.send_message(message.chat.id, "Привет!")
+
+    async def handle_voice(self, message):
+        s = self.session(message.chat.id)
+        msg = await self.send_message(message.chat.id, "…")
+        s.to_delete.append(msg.message_id)
+        raw, punctuated = await self.transcribe_message(s, message, msg.message_id)
+        if not punctuated:
+            await self.edit_text(s, msg.message_id, "Не удалось распознать речь")
+            return
+
+        if s.wait_value == 'comment':
+            s.comment = punctuated
+            await self.edit_text(s, msg.message_id, punctuated)
+        else:
+            s.text_raw = s.text + raw + " "
+            s.text += punctuated + " "
+            await self.edit_text(s, msg.message_id, punctuated, reply_markup=voice_markup())
+
+    async def handle_image(self, message):
+        s = self.session(message.chat.id)
+        lines = await self.recognize_photo(message.photo[-1])
+        text = '\n'.join(lines)
+        if message.caption:
+            text += '\n\n' + message.caption
+        s.text += text + " "
+
+        msg = await self.send_message(message.chat.id, text, reply_markup=voice_markup())
+        s.to_delete.append(msg.message_id)
+
+    async def handle_text(self, message):
+        s = self.session(message.chat.id)
+        if message.text.startswith("/clear"):
+            await self.clear(s)
+        elif message.text.startswith("/status"):
+            await self.send_message(message.chat.id, status_message(self.services.tm))
+        elif message.text.startswith("/random_number"):
+            await self.send_message(message.chat.id, random.randint(0, 100))
+        elif message.text.startswith("/yes_or_no"):
+            await self.send_message(message.chat.id, random.choice(("yes", "no")))
+        elif s.wait_value == "year":
+            try:
+                s.year = int(message.text)
+            except ValueError:
+                await self.send_message(message.chat.id, "### Error processing year, try again. ###")
+        elif s.wait_value == "rating":
+            try:
+                s.rating = int(message.text)
+                s.wait_value = "comment"
+                await self.send_message(message.chat.id, "Добавь комментарий", reply_markup=write_movie_markup())
+            except ValueError:
+                await self.send_message(message.chat.id, "### Error processing rating, try again. ###")
+        elif s.wait_value == "comment":
+            s.comment = message.text
+        elif s.wait_value == "tag":
+            s.tags.append(message.text)
+        else:
+            try:
+                amount = int(message.text)
+            except ValueError:
+                s.text += message.text + " "
+                msg = await self.send_message(message.chat.id, s.text, reply_markup=voice_markup())
+                s.to_delete.append(msg.message_id)
+                return
+            msg_id = await self.handle_expense(s, amount)
+            s.to_delete.append(msg_id)
+
+
+def main():
+    import services
+    config = services.config
+    executor = InferenceExecutor(config.get('inference_lanes'), wait_timeout=float(config.get('inference_wait', 30)))
+    bot = AsyncNoteBot(config['tg_api_token'], config['note_db_path'], config['admin_chat_id'],
+                       SimpleNamespace(tm=services.tm, punct=services.punct, ocr=services.ocr,
+                                       sheet_writer=services.sheet_writer, ms=services.ms, posters=services.posters),
+                       executor,
+                       session_ttl=float(config.get('session_ttl', 86400)),
+                       max_sessions=int(config.get('max_sessions', 1000)),
+                       session_path=services.session_path,
+                       stream_edit_interval=services.stream_edit_interval,
+                       transcribe_workers=int(config.get("transcribe_workers", 4)))
+    startup.mark("polling started")
+    asyncio.run(bot.infinity_polling())
+
+
+if __name__ == '__main__':
+    main()
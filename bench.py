@@ -0,0 +1,711 @@
+import os
+import re
+import time
+import asyncio
+import difflib
+import random
+import shutil
+import argparse
+import tempfile
+import urllib.parse
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+
+import thoughts
+from index import VectorIndex
+from store import ThoughtStore
+import transcribe
+
+WORDS_EN = "note idea project life memory thought river mountain city book film music science garden morning evening friend work plan question answer".split()
+WORDS_RU = "заметка идея проект жизнь память мысль река гора город книга фильм музыка наука сад утро вечер друг работа план вопрос ответ".split()
+TAGS = ['idea', 'project', 'life', 'diary', 'voice', 'random', 'books', 'films']
+
+
+def make_sentence(rng):
+    words = WORDS_RU if rng.random() < 0.5 else WORDS_EN
+    sentence = ' '.join(rng.choice(words) for _ in range(rng.randint(4, 16))).capitalize()
+    if rng.random() < 0.1:
+        sentence += f" https://example.com/{rng.randint(0, 10**6)}"
+    return sentence + '.'
+
+
+def make_note(rng, names):
+    tags = ' '.join('#' + t for t in rng.sample(TAGS, rng.randint(1, 3)))
+    body = '\n'.join(make_sentence(rng) for _ in range(rng.randint(1, 12)))
+    links = '\n'.join(f"[[{rng.choice(names)}]]" for _ in range(rng.randint(0, 3)))
+    return f"{tags}\n2023-01-01 12-00-00\n\n---\n{body}\n\n---\n{links}"
+
+
+def make_vault(root, n_notes, n_folders=20, seed=0):
+    rng = random.Random(seed)
+    names = [f"note {i}" for i in range(n_notes)]
+    for i, name in enumerate(names):
+        folder = os.path.join(root, f"folder {i % n_folders}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"{name}.md"), 'w') as f:
+            f.write(make_note(rng, names))
+    return root
+
+
+def legacy_parse_note_db(db_path, len_thr):
+    # parse_note_db before the streaming scanner, kept for comparison
+    path, folders, files = next(os.walk(db_path))
+    note_dfs = [legacy_parse_note_db(os.path.join(path, f), len_thr) for f in folders]
+    db_df = pd.DataFrame()
+    for fn in files:
+        if '.md' not in fn:
+            continue
+        filepath = os.path.join(path, fn)
+        with open(filepath, 'r') as f:
+            note = f.read()
+        if len(note) < len_thr:
+            continue
+        note_dict = {'name': fn.split('.md')[0], 'path': filepath, 'note': [note],
+                     'cleaned_note': [thoughts.clean(note)], 'tags': ', '.join(thoughts.find_tags(note))}
+        db_df = pd.concat([db_df, pd.DataFrame(note_dict)])
+    note_dfs.append(db_df)
+    return pd.concat(note_dfs)
+
+
+def fmt_time(seconds, width):
+    return f"{seconds:.2f}s".rjust(width) if seconds is not None else '-'.rjust(width)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_scan(args):
+    print(f"{'notes':>8} {'legacy parse':>14} {'parse':>10} {'legacy thoughts':>16} {'thoughts':>10}")
+    for n_notes in args.sizes:
+        root = make_vault(tempfile.mkdtemp(), n_notes)
+        try:
+            legacy_df, legacy_parse = timed(legacy_parse_note_db, root, 40) if n_notes <= args.legacy_max else (None, None)
+            df, parse = timed(thoughts.parse_note_db, root, 40)
+            notes = list(df.cleaned_note.values)
+            _, legacy_extract = timed(lambda: list(map(thoughts.get_thoughts, notes)))
+            _, extract = timed(thoughts.extract_all_thoughts, notes)
+            print(f"{n_notes:>8} {fmt_time(legacy_parse, 14)} {fmt_time(parse, 10)} {fmt_time(legacy_extract, 16)} {fmt_time(extract, 10)}")
+        finally:
+            shutil.rmtree(root)
+
+
+def load_embedder(model_name, token_budget=8192):
+    # just the attributes ThoughtManager.encode needs, without parsing a vault
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    return SimpleNamespace(tokenizer=tokenizer, model=model, device='cpu', token_budget=token_budget, torch=torch,
+                           dim=model.config.hidden_size, num_threads=None, load_model=lambda: None)
+
+
+def legacy_embed(embedder, texts, batch_size=32):
+    # ThoughtManager.embed before dynamic padding, kept for comparison
+    embeddings = []
+    for i in range(0, len(texts), batch_size):
+        tokenized = embedder.tokenizer(texts[i:i+batch_size], return_tensors='pt', padding='max_length', truncation=True)
+        with embedder.torch.no_grad():
+            encoded = embedder.model(**tokenized)
+        for bn, states in enumerate(encoded.last_hidden_state):
+            embeddings.append(states[tokenized['attention_mask'][bn] == 1].mean(dim=0))
+    return embedder.torch.vstack(embeddings).numpy()
+
+
+def bench_embed(args):
+    rng = random.Random(0)
+    texts = [make_sentence(rng) for _ in range(args.n_thoughts)]
+    embedder = load_embedder(args.model, args.token_budget)
+
+    legacy, legacy_time = timed(legacy_embed, embedder, texts)
+    embeddings, embed_time = timed(thoughts.ThoughtManager.encode, embedder, texts)
+    print(f"legacy:  {len(texts) / legacy_time:8.1f} thoughts/s")
+    print(f"dynamic: {len(texts) / embed_time:8.1f} thoughts/s")
+    print(f"max abs difference: {np.abs(legacy - embeddings).max():.2e}")
+
+
+def make_vectors(n, dim, n_clusters=200, seed=0):
+    # clustered gaussian vectors, closer to sentence embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    return centers[rng.integers(0, n_clusters, n)] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+
+
+def bench_index(args):
+    vectors = make_vectors(args.n_vectors + args.n_queries, args.dim)
+    vectors, queries = vectors[:args.n_vectors], vectors[args.n_vectors:]
+    ids = np.arange(args.n_vectors)
+    # incremental updates: the index is built without the last `churn` share of the vectors,
+    # then as many random ids are removed and the held back vectors added
+    rng = np.random.default_rng(0)
+    n_churn = int(args.churn * args.n_vectors)
+    initial = ids[:args.n_vectors - n_churn]
+    removed = rng.choice(initial, n_churn, replace=False)
+    final = np.setdiff1d(ids, removed)
+
+    print(f"{'backend':>8} {'metric':>6} {'build':>8} {'ms/query':>9} {f'recall@{args.k}':>10} {'after churn':>12}")
+    for metric in ['l2', 'ip']:
+        baseline = VectorIndex(args.dim, 'flat', metric)
+        baseline.build(ids, vectors)
+        _, truth = baseline.search(queries, args.k)
+        baseline.build(final, vectors[final])
+        _, churn_truth = baseline.search(queries, args.k)
+        for backend in ['flat', 'ivf', 'hnsw']:
+            index = VectorIndex(args.dim, backend, metric)
+            _, build_time = timed(index.build, ids, vectors)
+            (_, found), search_time = timed(index.search, queries, args.k)
+            recall = np.mean([len(set(t).intersection(f)) / args.k for t, f in zip(truth, found)])
+
+            index.build(initial, vectors[initial])
+            index.remove(removed)
+            index.add(ids[len(initial):], vectors[len(initial):])
+            _, found = index.search(queries, args.k)
+            if np.isin(found, removed).any():
+                raise AssertionError(f"{backend} returned removed ids")
+            churn_recall = np.mean([len(set(t).intersection(f)) / args.k for t, f in zip(churn_truth, found)])
+            print(f"{backend:>8} {metric:>6} {fmt_time(build_time, 8)} {1000 * search_time / len(queries):>9.3f} {recall:>10.3f} {churn_recall:>12.3f}")
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure_load(load, *args):
+    # runs in a fresh process, so the RSS delta is the loaded tables only
+    before = rss()
+    tables = load(*args)
+    return rss() - before, sum(t.memory_usage(deep=True).sum() for t in tables)
+
+
+def load_exploded(csv_path):
+    return [pd.read_csv(csv_path, sep=';')]
+
+
+def load_normalized(store_path):
+    store = ThoughtStore(store_path, dim=1)
+    return [store.load_notes(), store.load_thoughts()]
+
+
+def bench_memory(args):
+    root = make_vault(tempfile.mkdtemp(), args.n_notes)
+    try:
+        df = thoughts.parse_note_db(root, 40)
+        df['thoughts'] = thoughts.extract_all_thoughts(list(df.cleaned_note.values))
+
+        # the exploded layout as it was saved to thoughts.csv
+        csv_path = os.path.join(root, 'thoughts.csv')
+        df.explode('thoughts').dropna(subset=['thoughts']).to_csv(csv_path, sep=';', index=False)
+
+        store_path = os.path.join(root, 'store')
+        os.makedirs(store_path)
+        notes = [dict(n, mtime=0, size=0, hash='') for n in df.to_dict('records')]
+        n_thoughts = sum(len(n['thoughts']) for n in notes)
+        ThoughtStore(store_path, dim=1).update_notes(notes, np.zeros((n_thoughts, 1)), [])
+
+        print(f"{args.n_notes} notes, {n_thoughts} thoughts")
+        for name, load, path in [('exploded', load_exploded, csv_path), ('normalized', load_normalized, store_path)]:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                rss_delta, frame_size = pool.submit(measure_load, load, path).result()
+            print(f"{name:>10}: RSS +{rss_delta / 2**20:7.1f} MiB, tables {frame_size / 2**20:7.1f} MiB")
+    finally:
+        shutil.rmtree(root)
+
+
+def make_speech(seconds, frame_rate=16000, seed=0):
+    # 2-6 s modulated tone bursts ("phrases") separated by short noisy pauses, as int16 mono samples
+    rng = np.random.default_rng(seed)
+    parts, length = [], 0
+    while length < seconds * frame_rate:
+        t = np.arange(int(rng.uniform(2, 6) * frame_rate)) / frame_rate
+        parts.append(8000 * np.sin(2 * np.pi * rng.uniform(150, 300) * t) * (0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)))
+        parts.append(50 * rng.normal(size=int(rng.uniform(0.3, 0.8) * frame_rate)))
+        length += len(parts[-2]) + len(parts[-1])
+    return np.concatenate(parts)[:seconds * frame_rate].astype(np.int16)
+
+
+def encode_voice(seconds, frame_rate=16000):
+    # synthetic speech encoded like a telegram voice message
+    result = subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-f', 's16le', '-ar', str(frame_rate), '-ac', '1',
+                             '-i', 'pipe:0', '-c:a', 'libopus', '-f', 'ogg', 'pipe:1'],
+                            input=make_speech(seconds, frame_rate).tobytes(), stdout=subprocess.PIPE, check=True)
+    return result.stdout
+
+
+def bench_transcribe(args):
+    voice = encode_voice(args.seconds)
+    for workers in [1, args.workers]:
+        recognizer = transcribe.StubRecognizer(latency=args.latency)
+        start = time.perf_counter()
+        chunks = transcribe.iter_transcription(voice, recognizer=recognizer, workers=workers)
+        next(chunks)
+        first = time.perf_counter() - start
+        list(chunks)
+        duration = time.perf_counter() - start
+        print(f"{workers} workers: first text after {first:.2f}s, {duration:.2f}s for {args.seconds}s of audio, {recognizer.calls} chunks")
+
+
+def bench_punct(args):
+    # punctuation is stripped from synthetic sentences and compared with the original
+    rng = random.Random(0)
+    references = [' '.join(make_sentence(rng) for _ in range(rng.randint(1, 4))) for _ in range(args.n_texts)]
+    inputs = [re.sub(r'[^\w\s]', '', r).lower() for r in references]
+
+    outputs = {}
+    for quantize in [False, True]:
+        punctuator = transcribe.Punctuator(args.model, num_threads=args.threads, quantize=quantize, cache_size=len(inputs))
+        outputs[quantize], duration = timed(punctuator.apply_batch, inputs, args.lang)
+        _, cached = timed(punctuator.apply_batch, inputs, args.lang)
+        quality = np.mean([difflib.SequenceMatcher(None, o, r).ratio() for o, r in zip(outputs[quantize], references)])
+        print(f"{'int8' if quantize else 'float32':>8}: {1000 * duration / len(inputs):7.1f} ms/text, "
+              f"cached {1000 * cached / len(inputs):5.2f} ms/text, similarity to reference {quality:.3f}")
+    agreement = np.mean([o == q for o, q in zip(outputs[False], outputs[True])])
+    print(f"int8 output identical to float32 for {100 * agreement:.1f}% of texts")
+
+
+# A minimal Bot API server: updates are injected by the benchmark, every bot call is
+# answered at once and recorded, so the bot's own latency is all that is measured.
+class StubTelegram:
+    def __init__(self, voice, photo, port=8081):
+        self.voice, self.photo, self.port = voice, photo, port
+        self.updates, self.next_update_id, self.next_message_id = [], 1, 1
+        self.new_update = asyncio.Event()
+        self.replies = {}
+
+    async def start(self):
+        from aiohttp import web
+        from telebot import asyncio_helper
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        app.router.add_get('/file/bot{token}/{path:.*}', self.download)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+        asyncio_helper.API_URL = f'http://127.0.0.1:{self.port}/bot{{0}}/{{1}}'
+        asyncio_helper.FILE_URL = f'http://127.0.0.1:{self.port}/file/bot{{0}}/{{1}}'
+
+    def inject(self, chat_id, kind):
+        message = {'message_id': self.next_message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if kind == 'text':
+            message['text'] = 'заметка о том что надо проверить'
+        elif kind == 'voice':
+            message['voice'] = {'file_id': 'voice', 'file_unique_id': 'voice', 'duration': 1}
+        else:
+            # every photo is new, so the ocr cache does not hide the inference cost
+            message['photo'] = [{'file_id': 'photo', 'file_unique_id': f'photo{self.next_message_id}', 'width': 640, 'height': 480}]
+        self.updates.append({'update_id': self.next_update_id, 'message': message})
+        self.next_update_id += 1
+        self.next_message_id += 1
+        self.new_update.set()
+        # resolved by the bot's final reply, the one carrying the note keyboard, or with None when it is busy
+        self.replies[chat_id] = asyncio.get_running_loop().create_future()
+        return self.replies[chat_id]
+
+    async def handle(self, request):
+        from aiohttp import web
+        # telebot sends url-encoded forms, also with GET requests
+        method, params = request.match_info['method'], dict(urllib.parse.parse_qsl((await request.read()).decode()))
+        if method == 'getUpdates':
+            offset = int(params.get('offset', 0))
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            if not self.updates:
+                self.new_update.clear()
+                try:
+                    await asyncio.wait_for(self.new_update.wait(), 1.)
+                except asyncio.TimeoutError:
+                    pass
+            return web.json_response({'ok': True, 'result': self.updates})
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot'}})
+        if method == 'getFile':
+            return web.json_response({'ok': True, 'result': {'file_id': params['file_id'], 'file_unique_id': params['file_id'], 'file_path': params['file_id']}})
+        if method in {'sendMessage', 'editMessageText', 'sendPhoto'}:
+            chat_id = int(params['chat_id'])
+            reply = self.replies.get(chat_id)
+            if reply is not None and not reply.done():
+                if 'reply_markup' in params:
+                    reply.set_result(time.perf_counter())
+                elif 'перегружен' in params.get('text', ''):
+                    reply.set_result(None)
+            self.next_message_id += 1
+            return web.json_response({'ok': True, 'result': {'message_id': self.next_message_id, 'date': int(time.time()),
+                                                             'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}})
+        return web.json_response({'ok': True, 'result': True})
+
+    async def download(self, request):
+        from aiohttp import web
+        return web.Response(body=self.voice if request.match_info['path'] == 'voice' else self.photo)
+
+
+def stub_services(args):
+    from ocr import OCRService
+
+    def readtext(image):
+        time.sleep(args.ocr_latency)
+        return [([], 'распознанный текст', 0.9)]
+
+    def readtext_batched(images):
+        # a batch costs one pass plus a little per image
+        time.sleep(args.ocr_latency * (1 + 0.25 * (len(images) - 1)))
+        return [[([], 'распознанный текст', 0.9)] for _ in images]
+
+    reader = SimpleNamespace(readtext=readtext, readtext_batched=readtext_batched)
+    return SimpleNamespace(punct=SimpleNamespace(apply=lambda text: text.capitalize() + '.'),
+                           ocr=OCRService(reader, max_queue=args.queue),
+                           recognizer=transcribe.StubRecognizer(latency=args.latency),
+                           tm=None, sheet_writer=None, ms=None)
+
+
+async def drive_telegram(args):
+    from async_bot import AsyncNoteBot
+    from inference import InferenceExecutor
+
+    import cv2
+    photo = cv2.imencode('.png', np.full((480, 640, 3), 255, dtype=np.uint8))[1].tobytes()
+    server = StubTelegram(encode_voice(args.seconds), photo)
+    await server.start()
+    executor = InferenceExecutor(wait_timeout=args.wait)
+    services = stub_services(args)
+    session_path = os.path.join(tempfile.mkdtemp(), 'sessions.sqlite') if args.persist_sessions else None
+    bot = AsyncNoteBot('1:stub', tempfile.gettempdir(), 0, services, executor, stream_edit_interval=0.5, session_path=session_path)
+    polling = asyncio.create_task(bot.polling(non_stop=True, timeout=1))
+
+    rng, kinds = random.Random(0), ['text', 'voice', 'photo']
+    latencies = {kind: [] for kind in kinds}
+
+    async def chat(chat_id):
+        for _ in range(args.messages):
+            kind = rng.choice(kinds)
+            start = time.perf_counter()
+            try:
+                done = await asyncio.wait_for(server.inject(chat_id, kind), args.wait + 30)
+                if done is not None:
+                    latencies[kind].append(done - start)
+            except asyncio.TimeoutError:
+                latencies[kind].append(np.inf)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(1000 + i) for i in range(args.chats)))
+    duration = time.perf_counter() - start
+    bot._polling = False
+    polling.cancel()
+    executor.shutdown()
+    await server.runner.cleanup()
+    return latencies, duration, executor.rejected + services.ocr.rejected
+
+
+def bench_telegram(args):
+    latencies, duration, rejected = asyncio.run(drive_telegram(args))
+    total = sum(len(v) for v in latencies.values())
+    print(f"{args.chats} chats x {args.messages} messages: {total / duration:.1f} answered updates/s, {rejected} rejected as busy")
+    for kind, values in latencies.items():
+        if values:
+            values = np.array(values)
+            print(f"{kind:>6}: {len(values):4d} updates, p50 {fmt_time(np.percentile(values, 50), 8)}, p95 {fmt_time(np.percentile(values, 95), 8)}")
+
+
+def wait_flushed(journal, timeout=60.):
+    deadline = time.monotonic() + timeout
+    while journal.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return time.perf_counter()
+
+
+def bench_journal(args):
+    from sheets import FakeSheetClient
+    from journal import SheetJournal
+    from concurrent.futures import ThreadPoolExecutor
+    rows = [[i, 'еда', f'comment {i}'] for i in range(args.rows)]
+
+    def write_all(target):
+        # every row is one button press in its own chat; returns the time each press waited
+        def press(row):
+            start = time.perf_counter()
+            target.write_row('финансы', 0, 'B', 'D', row)
+            return time.perf_counter() - start
+        with ThreadPoolExecutor(args.chats) as pool:
+            return np.array(list(pool.map(press, rows)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sheets = FakeSheetClient(latency=args.latency)
+        start = time.perf_counter()
+        waits = write_all(sheets)
+        print(f"inline:  press waits p50 {fmt_time(np.percentile(waits, 50), 8)}, p95 {fmt_time(np.percentile(waits, 95), 8)}, "
+              f"{args.rows} rows in {time.perf_counter() - start:.2f}s, {sheets.requests} requests")
+
+        sheets = FakeSheetClient(latency=args.latency, fail_rate=args.fail_rate)
+        journal = SheetJournal(os.path.join(tmp, 'journal.sqlite'), sheets, batch_wait=args.batch_wait, retry_min=0.05)
+        start = time.perf_counter()
+        waits = write_all(journal)
+        end = wait_flushed(journal)
+        print(f"journal: press waits p50 {fmt_time(np.percentile(waits, 50), 8)}, p95 {fmt_time(np.percentile(waits, 95), 8)}, "
+              f"{args.rows} rows in the sheet after {end - start:.2f}s, {sheets.requests} requests, {journal.failures} failed")
+        assert sorted(sheets.rows[('финансы', 0)]) == sorted(rows)
+
+        # rows stored before a crash are sent by the next process
+        path = os.path.join(tmp, 'crash.sqlite')
+        crashed = SheetJournal(path, sheets, start=False)
+        for row in rows:
+            crashed.write_row('фильмы', 1, 'A', 'P', row)
+        crashed.conn.close()
+        sheets = FakeSheetClient(latency=args.latency)
+        start = time.perf_counter()
+        journal = SheetJournal(path, sheets)
+        end = wait_flushed(journal)
+        recovered = sheets.rows[('фильмы', 1)]
+        print(f"recovery: {len(recovered)} of {args.rows} rows sent in order after {end - start:.2f}s: {recovered == rows}")
+
+
+def bench_categories(args):
+    from finance import similarity, CategoryMatcher, SheetWriter
+    from sheets import FakeSheetClient
+    rng = random.Random(0)
+    categories = sorted({' '.join(rng.choice(WORDS_RU) for _ in range(rng.randint(1, 2))) for _ in range(args.categories)})
+    texts = [[rng.choice(WORDS_RU + categories) for _ in range(args.words)] for _ in range(args.n_texts)]
+
+    def legacy(words):
+        # what parse_expense did before: a fresh set per category and word
+        return [max(((c, similarity(w, c)) for c in categories), key=lambda x: x[1]) for w in words]
+
+    start = time.perf_counter()
+    matcher = CategoryMatcher(categories)
+    build = time.perf_counter() - start
+    for name, match in [('legacy', legacy), ('matcher', matcher.best)]:
+        start = time.perf_counter()
+        for words in texts:
+            match(words)
+        print(f"{name:>8}: {(time.perf_counter() - start) / len(texts) * 1e6:8.1f}us per {args.words}-word text, {len(categories)} categories")
+    print(f"matcher built in {build * 1e6:.1f}us")
+
+    # a stale list is served while the sheet is read again
+    sheets = FakeSheetClient(latency=args.latency, columns={('финансы', 2): categories})
+    writer = SheetWriter(sheets, refresh_interval=0.)
+    waits = []
+    for _ in range(100):
+        start = time.perf_counter()
+        writer.categories
+        waits.append(time.perf_counter() - start)
+    time.sleep(args.latency * 2)
+    print(f"categories during a refresh: max {max(waits) * 1e6:.1f}us per access, sheet latency {args.latency:.2f}s, {sheets.requests} sheet reads")
+
+
+def make_tiny_model(path, dim=64, seed=0):
+    # a randomly initialized BERT with a vocabulary of the synthetic words; times depend on the
+    # code around the model, not on its weights
+    import torch
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+    if os.path.exists(os.path.join(path, 'config.json')):
+        return path
+    os.makedirs(path, exist_ok=True)
+    letters = sorted(set(''.join(WORDS_EN + WORDS_RU)) | set('0123456789'))
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS_EN + WORDS_RU + list('.,!?:/#-') + letters + ['##' + c for c in letters]
+    with open(os.path.join(path, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(dict.fromkeys(vocab)))
+    BertTokenizerFast(os.path.join(path, 'vocab.txt'), model_max_length=512).save_pretrained(path)
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=len(dict.fromkeys(vocab)), hidden_size=dim, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=2 * dim, max_position_embeddings=512)
+    BertModel(config).save_pretrained(path)
+    return path
+
+
+def make_expense(rng, categories):
+    amount, category = rng.randint(1, 20000), rng.choice(categories)
+    words = [rng.choice(WORDS_RU) for _ in range(rng.randint(0, 4))]
+    if rng.random() < 0.5:
+        # amount and category out of order, parsed by the fallback
+        words.insert(rng.randint(0, len(words)), f"{amount}р")
+        words.insert(rng.randint(0, len(words)), category[:-1])
+        return 'трата ' + ' '.join(words)
+    return ' '.join(['расход', str(amount), category] + words)
+
+
+def median_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def run_suite(args, root):
+    # name -> seconds, lower is better
+    from finance import SheetWriter
+    from parse import parse_message
+    from sheets import FakeSheetClient
+    rng = random.Random(args.seed)
+    results = {}
+
+    vault = make_vault(os.path.join(root, 'vault'), args.notes, seed=args.seed)
+    results['parse_note_db'] = median_time(lambda: thoughts.parse_note_db(vault, 40), args.repeat)
+    notes = list(thoughts.parse_note_db(vault, 40).cleaned_note.values)
+    results['extract_thoughts'] = median_time(lambda: thoughts.extract_all_thoughts(notes), args.repeat)
+
+    model = make_tiny_model(os.path.join(root, 'model'))
+    tm = thoughts.ThoughtManager(vault, model_name=model, save_path=os.path.join(root, 'saved'), watch_debounce=3600.)
+    tm.ready.wait()
+    start = time.perf_counter()
+    tm.parse_thoughts()
+    results['reindex_full'] = time.perf_counter() - start
+    texts = [make_sentence(rng) for _ in range(args.thoughts)]
+    results['encode_per_1k_thoughts'] = median_time(lambda: tm.encode(texts), args.repeat) / len(texts) * 1000
+    # fresh texts every run, so the query embeddings are never cached
+    queries = iter([' '.join(make_sentence(rng) for _ in range(3)) for _ in range(2 * args.queries * args.repeat)])
+    results['get_nearest'] = median_time(lambda: [tm.get_nearest(next(queries), 25) for _ in range(args.queries)], args.repeat) / args.queries
+    results['suggest_tags'] = median_time(lambda: [tm.suggest_tags(next(queries)) for _ in range(args.queries)], args.repeat) / args.queries
+
+    messages = [' '.join(make_sentence(rng) for _ in range(rng.randint(1, 5))) for _ in range(1000)]
+    messages = [rng.choice(['идея ', 'project ', '']) + m for m in messages]
+    results['parse_message_per_1k'] = median_time(lambda: [parse_message(m, ['books'], ['note 1']) for m in messages], args.repeat)
+
+    categories = sorted(set(WORDS_RU))
+    writer = SheetWriter(FakeSheetClient(latency=0., columns={('финансы', 2): categories}))
+    expenses = [make_expense(rng, categories) for _ in range(1000)]
+    results['parse_expense_per_1k'] = median_time(lambda: [writer.parse_expense(e) for e in expenses], args.repeat)
+
+    voice = encode_voice(args.seconds)
+    recognizer = transcribe.StubRecognizer()
+    results['transcribe_audio'] = median_time(lambda: transcribe.transcribe_audio(voice, recognizer=recognizer), args.repeat)
+    # chunks no longer than the search window still cover the audio, one after another
+    samples = make_speech(args.seconds)
+    for chunk_len in [0.01, 1, 10, 50]:
+        chunks = transcribe.find_chunks(samples, 16000, chunk_len)
+        assert chunks[0][0] == 0 and chunks[-1][1] == len(samples), chunk_len
+        assert all(0 < end - start <= int(16000 * chunk_len) for start, end in chunks), chunk_len
+        assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:])), chunk_len
+    return results
+
+
+def compare(results, baseline, threshold):
+    # names of the results slower than the baseline by more than `threshold`
+    regressions = []
+    print(f"{'benchmark':>24} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, value in results.items():
+        if name not in baseline:
+            print(f"{name:>24} {'-':>12} {value:>11.4f}s")
+            continue
+        reference = baseline[name]
+        change = value / reference - 1 if reference > 0 else 0.
+        slower = change > threshold
+        if slower:
+            regressions.append(name)
+        print(f"{name:>24} {reference:>11.4f}s {value:>11.4f}s {change:>+7.0%}{'  slower' if slower else ''}")
+    return regressions
+
+
+def bench_suite(args):
+    import json
+    import platform
+    root = tempfile.mkdtemp()
+    try:
+        results = run_suite(args, root)
+    finally:
+        shutil.rmtree(root)
+    report = {'meta': {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'args': {k: v for k, v in vars(args).items() if k not in {'func', 'out', 'baseline'}}},
+              'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    scan = subparsers.add_parser('scan', help='vault parsing and thought extraction')
+    scan.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    scan.add_argument('--legacy-max', type=int, default=5000, help='skip the quadratic legacy parser above this size')
+    scan.set_defaults(func=bench_scan)
+
+    embed = subparsers.add_parser('embed', help='ThoughtManager.encode throughput')
+    embed.add_argument('--model', default='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+    embed.add_argument('--n-thoughts', type=int, default=2000)
+    embed.add_argument('--token-budget', type=int, default=8192)
+    embed.set_defaults(func=bench_embed)
+
+    index = subparsers.add_parser('index', help='recall@k and latency of the index backends against flat search')
+    index.add_argument('--n-vectors', type=int, default=100000)
+    index.add_argument('--n-queries', type=int, default=1000)
+    index.add_argument('--dim', type=int, default=384)
+    index.add_argument('--k', type=int, default=25)
+    index.add_argument('--churn', type=float, default=0.1, help='share of the vectors removed and added after the build')
+    index.set_defaults(func=bench_index)
+
+    memory = subparsers.add_parser('memory', help='RSS of the exploded and the normalized thought tables')
+    memory.add_argument('--n-notes', type=int, default=20000)
+    memory.set_defaults(func=bench_memory)
+
+    transcription = subparsers.add_parser('transcribe', help='transcribe_audio with a stub recognizer')
+    transcription.add_argument('--seconds', type=int, default=600)
+    transcription.add_argument('--latency', type=float, default=1., help='stub recognizer latency per chunk')
+    transcription.add_argument('--workers', type=int, default=4)
+    transcription.set_defaults(func=bench_transcribe)
+
+    punct = subparsers.add_parser('punct', help='Punctuator latency and quality, float32 against int8')
+    punct.add_argument('--model', required=True, help='path to the torch package of the punctuation model')
+    punct.add_argument('--n-texts', type=int, default=200)
+    punct.add_argument('--threads', type=int, default=None)
+    punct.add_argument('--lang', default='ru')
+    punct.set_defaults(func=bench_punct)
+
+    telegram = subparsers.add_parser('telegram', help='async runtime against a stub Bot API server with stub models')
+    telegram.add_argument('--chats', type=int, default=20)
+    telegram.add_argument('--messages', type=int, default=10)
+    telegram.add_argument('--seconds', type=int, default=60, help='length of the voice messages')
+    telegram.add_argument('--latency', type=float, default=0.3, help='stub recognizer latency per chunk')
+    telegram.add_argument('--ocr-latency', type=float, default=0.2)
+    telegram.add_argument('--queue', type=int, default=8, help='photos the ocr worker may have queued')
+    telegram.add_argument('--wait', type=float, default=5., help='seconds to wait for a lane before replying busy')
+    telegram.add_argument('--persist-sessions', action='store_true', help='keep sessions in SQLite, as with persist_sessions')
+    telegram.set_defaults(func=bench_telegram)
+
+    journal = subparsers.add_parser('journal', help='sheet writes inline against the write-behind journal, on a fake sheets backend')
+    journal.add_argument('--rows', type=int, default=200)
+    journal.add_argument('--chats', type=int, default=8)
+    journal.add_argument('--latency', type=float, default=0.3, help='fake sheets latency per request')
+    journal.add_argument('--fail-rate', type=float, default=0.2, help='share of fake sheets requests that fail')
+    journal.add_argument('--batch-wait', type=float, default=0.2)
+    journal.set_defaults(func=bench_journal)
+
+    categories = subparsers.add_parser('categories', help='expense category matching, per-word sets against the CategoryMatcher, and background refresh')
+    categories.add_argument('--categories', type=int, default=40)
+    categories.add_argument('--words', type=int, default=8)
+    categories.add_argument('--n-texts', type=int, default=2000)
+    categories.add_argument('--latency', type=float, default=0.5, help='fake sheets latency of a category read')
+    categories.set_defaults(func=bench_categories)
+
+    suite = subparsers.add_parser('suite', help='offline regression suite on a synthetic vault, a tiny model and synthetic audio')
+    suite.add_argument('--notes', type=int, default=2000)
+    suite.add_argument('--thoughts', type=int, default=1000, help='thoughts encoded per run')
+    suite.add_argument('--queries', type=int, default=20, help='searches per run')
+    suite.add_argument('--seconds', type=int, default=120, help='length of the synthetic voice message')
+    suite.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the median is reported')
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--out', help='write the results to this JSON file')
+    suite.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    suite.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline')
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
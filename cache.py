@@ -0,0 +1,95 @@
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import Future
+import numpy as np
+
+
+class EmbeddingCache:
+    def __init__(self, path, model_name, max_size=200000):
+        self.model_name, self.max_size = model_name, max_size
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB, used INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)')
+        self.clock = self.conn.execute('SELECT COALESCE(MAX(used), 0) FROM embeddings').fetchone()[0]
+
+    def key(self, text):
+        return hashlib.sha1(f"{self.model_name}\n{text}".encode('utf-8')).hexdigest()
+
+    def get(self, texts):
+        # cached embedding or None for every text, hits are marked as recently used
+        keys = [self.key(t) for t in texts]
+        found = {}
+        with self.lock:
+            self.clock += 1
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                marks = ','.join('?' * len(chunk))
+                rows = self.conn.execute(f'SELECT key, embedding FROM embeddings WHERE key IN ({marks})', chunk)
+                found.update((k, np.frombuffer(e, dtype=np.float32)) for k, e in rows)
+                self.conn.execute(f'UPDATE embeddings SET used = ? WHERE key IN ({marks})', [self.clock] + chunk)
+            self.conn.commit()
+        return [found.get(k) for k in keys]
+
+    def put(self, texts, embeddings):
+        rows = [(self.key(t), np.asarray(e, dtype=np.float32).tobytes()) for t, e in zip(texts, embeddings)]
+        with self.lock:
+            self.clock += 1
+            self.conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)', [(k, e, self.clock) for k, e in rows])
+            # evict least recently used entries above the size limit
+            size = self.conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            if size > self.max_size:
+                self.conn.execute('DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)', (size - self.max_size,))
+            self.conn.commit()
+
+
+# JSON values in SQLite that expire after a per-entry ttl. Concurrent get_or_fetch calls
+# for the same key share one fetch.
+class TTLCache:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE expires < ?', (time.time(),))
+            self.conn.commit()
+        self.inflight = {}
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM entries WHERE key = ? AND expires >= ?', (key, time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', (key, json.dumps(value), time.time() + ttl))
+            self.conn.commit()
+
+    def get_or_fetch(self, key, ttl, fetch):
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            # another caller may have finished the same fetch in between
+            value = self.get(key)
+            if value is None:
+                value = fetch()
+                self.put(key, value, ttl)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
@@ -1,7 +1,7 @@
 import re
+import time
+import threading
 import numpy as np
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 
 def similarity(query, reference):
     common_letters = set(query).intersection(set(reference))
@@ -14,21 +14,61 @@ def similarity(query, reference):
     return f1
 
 def get_most_similar(query, categories):
-    similarities = list(map(lambda cat: similarity(query, cat), categories))
-    return categories[np.argmax(similarities)], max(similarities)
+    return CategoryMatcher(categories).best([query])[0]
+
+
+# The F1 of `similarity` against every category at once. Categories are rows of a
+# characters matrix built once; F1 of two letter sets is 2 * common / (|query| + |category|).
+class CategoryMatcher:
+    def __init__(self, categories):
+        self.categories = list(categories)
+        self.alphabet = {c: i for i, c in enumerate(sorted(set(''.join(self.categories))))}
+        self.letters = self.encode(self.categories)
+        self.sizes = self.letters.sum(axis=1)
+
+    def encode(self, words):
+        letters = np.zeros((len(words), len(self.alphabet)), dtype=np.float64)
+        for i, word in enumerate(words):
+            letters[i, [self.alphabet[c] for c in set(word) if c in self.alphabet]] = 1
+        return letters
+
+    def scores(self, words):
+        # words x categories
+        common = self.encode(words) @ self.letters.T
+        sizes = np.array([len(set(w)) for w in words], dtype=np.float64)[:, None] + self.sizes[None, :]
+        return np.divide(2 * common, sizes, out=np.zeros_like(common), where=sizes > 0)
+
+    def best(self, words):
+        # the most similar category of every word and its score
+        scores = self.scores(words)
+        best = scores.argmax(axis=1)
+        return [(self.categories[j], float(scores[i, j])) for i, j in enumerate(best)]
 
 
 class SheetWriter:
-    def __init__(self, cred_path):
-        scopes = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        self.credentials = ServiceAccountCredentials.from_json_keyfile_name(cred_path, scopes) 
-        self.categories = self.get_categories()
+    def __init__(self, sheets, refresh_interval=3600.):
+        self.sheets, self.refresh_interval = sheets, refresh_interval
+        self.matcher, self.loaded_at = CategoryMatcher(self.get_categories()), time.monotonic()
+        self.refreshing = threading.Lock()
+
+    @property
+    def categories(self):
+        # a stale list is still returned while a fresh one is read in the background
+        if time.monotonic() - self.loaded_at > self.refresh_interval and self.refreshing.acquire(blocking=False):
+            threading.Thread(target=self.refresh, daemon=True).start()
+        return self.matcher.categories
+
+    def refresh(self):
+        try:
+            self.matcher = CategoryMatcher(self.get_categories())
+        except Exception as e:
+            print(f"### Cannot refresh expense categories: {e} ###")
+        finally:
+            self.loaded_at = time.monotonic()
+            self.refreshing.release()
 
     def write_to_gsheet(self, amount, category, comment):
-        file = gspread.authorize(self.credentials) 
-        sheet = file.open('финансы').worksheets()[0]
-        write_row_ind = len(sheet.col_values(1)) + 1
-        sheet.update(f"B{write_row_ind}:D{write_row_ind}", [[amount, category, comment]])
+        self.sheets.write_row('финансы', 0, 'B', 'D', [amount, category, comment])
 
     def parse_expense(self, text):
         if "трат" in text[:15].lower():
@@ -42,7 +82,7 @@ class SheetWriter:
             comment = ' '.join(comment)
 
             if category not in self.categories:
-                category, similarity = get_most_similar(category, self.categories)
+                (category, similarity), = self.matcher.best([category])
                 if similarity < 0.85:
                     raise ValueError
         except ValueError:
@@ -52,7 +92,7 @@ class SheetWriter:
             amount_ind = np.argmax(list(map(len, amount_candidates)))
             amount = int(amount_candidates[amount_ind])
 
-            similarity_scores = [get_most_similar(w, self.categories) for w in words]
+            similarity_scores = self.matcher.best(words)
             category_ind = np.argmax(list(map(lambda x: x[1], similarity_scores)))
             category = similarity_scores[category_ind][0]
 
@@ -61,6 +101,4 @@ class SheetWriter:
         return amount, category, comment
 
     def get_categories(self):
-        file = gspread.authorize(self.credentials) 
-        sheet = file.open('финансы').worksheets()[2]
-        return sheet.col_values(1)
\ No newline at end of file
+        return self.sheets.col_values('финансы', 2, 1)
\ No newline at end of file
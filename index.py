@@ -0,0 +1,137 @@
+import os
+import copy
+import json
+import numpy as np
+import faiss
+
+
+# faiss index keyed by stable thought ids, so single notes can be added and removed.
+# ivf keeps the ids in its inverted lists itself; flat and hnsw are wrapped in an id map,
+# which is only correct for indexes that renumber the rest on removal, and ivf does not.
+# With metric='ip' vectors are L2-normalized and distances are reported as 1 - cosine,
+# so smaller is closer for every backend.
+class VectorIndex:
+    def __init__(self, dim, backend='flat', metric='l2', nlist=1024, nprobe=16, hnsw_m=32, ef_construction=80, ef_search=64):
+        if backend not in {'flat', 'ivf', 'hnsw'}:
+            raise ValueError(f'Unknown index backend: {backend}')
+        if metric not in {'l2', 'ip'}:
+            raise ValueError(f'Unknown index metric: {metric}')
+        self.dim, self.backend, self.metric = dim, backend, metric
+        self.nlist, self.nprobe = nlist, nprobe
+        self.hnsw_m, self.ef_construction, self.ef_search = hnsw_m, ef_construction, ef_search
+        self.build(np.zeros(0, dtype=np.int64), np.zeros((0, dim), dtype=np.float32))
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal - len(self.removed)
+
+    def prepare(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.metric == 'ip':
+            vectors = vectors.copy()
+            faiss.normalize_L2(vectors)
+        return vectors
+
+    def build(self, ids, vectors):
+        vectors = self.prepare(vectors)
+        faiss_metric = faiss.METRIC_INNER_PRODUCT if self.metric == 'ip' else faiss.METRIC_L2
+        if self.backend == 'flat':
+            base = faiss.IndexFlat(self.dim, faiss_metric)
+        elif self.backend == 'ivf':
+            # fewer lists than requested for small vaults, ~39 points per centroid
+            self.quantizer = faiss.IndexFlat(self.dim, faiss_metric)
+            base = faiss.IndexIVFFlat(self.quantizer, self.dim, max(1, min(self.nlist, len(vectors) // 39)), faiss_metric)
+            if len(vectors) > 0:
+                base.train(vectors)
+            base.nprobe = self.nprobe
+        else:
+            base = faiss.IndexHNSWFlat(self.dim, self.hnsw_m, faiss_metric)
+            base.hnsw.efConstruction = self.ef_construction
+            base.hnsw.efSearch = self.ef_search
+        self.base, self.index = base, base if self.backend == 'ivf' else faiss.IndexIDMap2(base)
+        # hnsw can not delete, removed ids are skipped by a selector during the search instead
+        self.set_removed(set())
+        if len(vectors) > 0:
+            self.index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+
+    def copy(self):
+        clone = copy.copy(self)
+        clone.index = faiss.clone_index(self.index)
+        clone.base = clone.index if self.backend == 'ivf' else faiss.downcast_index(clone.index.index)
+        clone.removed = set(self.removed)
+        return clone
+
+    def params(self):
+        return {'backend': self.backend, 'metric': self.metric, 'nlist': self.nlist, 'nprobe': self.nprobe,
+                'hnsw_m': self.hnsw_m, 'ef_construction': self.ef_construction, 'ef_search': self.ef_search}
+
+    def save(self, path, key):
+        # `key` identifies the vectors the index was built from, load() only accepts a matching one
+        faiss.write_index(self.index, path + '.tmp')
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump({'key': key, 'params': self.params(), 'removed': sorted(self.removed)}, f)
+        os.replace(path + '.tmp', path)
+        os.replace(path + '.json.tmp', path + '.json')
+
+    def load(self, path, key):
+        if not os.path.exists(path) or not os.path.exists(path + '.json'):
+            return False
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        if meta['key'] != key or meta['params'] != self.params():
+            return False
+        index = faiss.read_index(path)
+        # ivf indexes saved inside an id map have drifted ids, they are rebuilt
+        if index.d != self.dim or isinstance(index, faiss.IndexIDMap) != (self.backend != 'ivf'):
+            return False
+        self.index, self.base = index, index if self.backend == 'ivf' else faiss.downcast_index(index.index)
+        if self.backend == 'ivf':
+            self.base.nprobe = self.nprobe
+        elif self.backend == 'hnsw':
+            self.base.hnsw.efSearch = self.ef_search
+        self.set_removed(set(meta['removed']))
+        return True
+
+    def needs_rebuild(self):
+        if self.backend == 'ivf':
+            # untrained, or trained on a much smaller vault than the current one
+            return not self.base.is_trained or (self.base.nlist < self.nlist and self.index.ntotal > 4 * 39 * self.base.nlist)
+        return len(self.removed) > 0.2 * max(self.index.ntotal, 1)
+
+    def add(self, ids, vectors):
+        if len(ids) > 0:
+            self.index.add_with_ids(self.prepare(vectors), np.asarray(ids, dtype=np.int64))
+
+    def remove(self, ids):
+        if len(ids) == 0:
+            return
+        if self.backend == 'hnsw':
+            self.set_removed(self.removed.union(int(i) for i in ids))
+        else:
+            self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def set_removed(self, removed):
+        self.removed = removed
+        if len(removed) == 0:
+            self.selector = None
+        else:
+            # the batch selector is kept referenced, the negation only points to it
+            batch = faiss.IDSelectorBatch(np.fromiter(removed, dtype=np.int64, count=len(removed)))
+            self.selector = batch, faiss.IDSelectorNot(batch)
+
+    def search(self, vectors, k):
+        # returns distances and thought ids, -1 where fewer than k were found
+        fetch = min(k, self.ntotal)
+        D = np.full((len(vectors), k), np.inf, dtype=np.float32)
+        I = np.full((len(vectors), k), -1, dtype=np.int64)
+        if fetch == 0:
+            return D, I
+
+        # the id map swaps the selector of the parameters during a search, so each search has its own
+        params = None if self.selector is None else faiss.SearchParametersHNSW(sel=self.selector[1], efSearch=self.ef_search)
+        found_D, found_I = self.index.search(self.prepare(vectors), fetch, params=params)
+        if self.metric == 'ip':
+            found_D = 1 - found_D
+        found = found_I >= 0
+        D[:, :fetch][found], I[:, :fetch][found] = found_D[found], found_I[found]
+        return D, I
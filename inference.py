@@ -0,0 +1,74 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# workers and waiting slots per lane; a lane that is full makes callers wait,
+# and a caller that waited `wait_timeout` seconds gets Busy
+DEFAULT_LANES = {
+    'embed': {'workers': 1, 'queue': 8},
+    'punct': {'workers': 1, 'queue': 16},
+    'io': {'workers': 8, 'queue': 64},
+}
+
+
+class Busy(Exception):
+    pass
+
+
+# Runs blocking calls off the event loop. Every kind of work has its own lane so a
+# backlog of embedding requests does not delay punctuation or network calls. Models
+# stay in this process; torch releases the GIL while computing.
+class InferenceExecutor:
+    def __init__(self, lanes=None, wait_timeout=30.):
+        lanes = {**DEFAULT_LANES, **(lanes or {})}
+        self.wait_timeout = wait_timeout
+        self.pools = {name: ThreadPoolExecutor(lane['workers'], thread_name_prefix=name) for name, lane in lanes.items()}
+        self.slots = {name: asyncio.Semaphore(lane['workers'] + lane['queue']) for name, lane in lanes.items()}
+        self.rejected = 0
+
+    async def acquire(self, lane):
+        try:
+            await asyncio.wait_for(self.slots[lane].acquire(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Busy(lane)
+
+    async def run(self, lane, fn, *args, **kwargs):
+        await self.acquire(lane)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pools[lane], lambda: fn(*args, **kwargs))
+        finally:
+            self.slots[lane].release()
+
+    async def iterate(self, lane, fn, *args, **kwargs):
+        # items of the blocking generator `fn(*args, **kwargs)` as they are produced
+        await self.acquire(lane)
+        loop, queue, stop, done = asyncio.get_running_loop(), asyncio.Queue(), threading.Event(), object()
+
+        def produce():
+            try:
+                for item in fn(*args, **kwargs):
+                    loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+                    if stop.is_set():
+                        break
+                loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (done, e))
+
+        future = loop.run_in_executor(self.pools[lane], produce)
+        try:
+            while True:
+                item, error = await queue.get()
+                if error is not None:
+                    raise error
+                if item is done:
+                    break
+                yield item
+        finally:
+            stop.set()
+            await asyncio.shield(future)
+            self.slots[lane].release()
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,119 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import defaultdict
+
+
+# Write-behind for sheet rows. A row is stored in SQLite and the caller returns at once; a
+# flusher thread sends the pending rows of each worksheet in one write_rows request, and a
+# row is deleted only after its request succeeded. Failed requests are retried with
+# exponential backoff, and rows left by a crash are sent on the next start. A crash between
+# a write and its delete sends that batch twice. A batch the API refuses is split: its rows
+# are sent one by one, and a row refused `max_attempts` times is moved to the `failed` table.
+def refused(error):
+    # the API rejected the request itself, e.g. 400 for a malformed row; 401 is handled by the
+    # client and 429 is a rate limit
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status is not None and 400 <= status < 500 and status not in {401, 429}
+
+
+class SheetJournal:
+    def __init__(self, path, sheets, batch_wait=1., max_batch=100, retry_min=1., retry_max=300., max_attempts=3, start=True):
+        self.sheets, self.batch_wait, self.max_batch, self.max_attempts = sheets, batch_wait, max_batch, max_attempts
+        self.retry_min, self.retry_max = retry_min, retry_max
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                          'target TEXT, row TEXT, attempts INTEGER DEFAULT 0, created REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS failed (id INTEGER PRIMARY KEY, target TEXT, row TEXT, error TEXT, failed REAL)')
+        self.conn.commit()
+        self.wakeup = threading.Event()
+        self.flushed, self.failures = 0, 0
+        if start:
+            self.start()
+
+    def start(self):
+        left = self.pending()
+        if left:
+            print(f"### Sheet journal: {left} rows left from the last run ###")
+            self.wakeup.set()
+        threading.Thread(target=self.flusher, daemon=True).start()
+
+    def col_values(self, name, index, col):
+        return self.sheets.col_values(name, index, col)
+
+    def write_row(self, name, index, first_col, last_col, values, count_cols='A:A'):
+        target = json.dumps([name, index, first_col, last_col, count_cols], ensure_ascii=False)
+        with self.lock:
+            self.conn.execute('INSERT INTO pending (target, row, created) VALUES (?, ?, ?)',
+                              (target, json.dumps(values, ensure_ascii=False, default=str), time.time()))
+            self.conn.commit()
+        self.wakeup.set()
+
+    def pending(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+
+    def flush(self):
+        # one request per worksheet; True if nothing failed
+        with self.lock:
+            rows = self.conn.execute('SELECT id, target, row, attempts FROM pending ORDER BY id').fetchall()
+        batches, closed = defaultdict(list), set()
+        for id, target, row, attempts in rows:
+            if target in closed or len(batches[target]) >= self.max_batch:
+                continue
+            # a row refused before goes alone, so it can not hold back the rows after it
+            if attempts > 0 and len(batches[target]) > 0:
+                closed.add(target)
+                continue
+            batches[target].append((id, json.loads(row)))
+            if attempts > 0:
+                closed.add(target)
+        ok = True
+        for target, batch in batches.items():
+            name, index, first_col, last_col, count_cols = json.loads(target)
+            ids = [id for id, _ in batch]
+            marks = ','.join('?' * len(ids))
+            try:
+                self.sheets.write_rows(name, index, first_col, last_col, [row for _, row in batch], count_cols)
+            except Exception as e:
+                print(f"### Sheet journal: {len(batch)} rows not written: {e} ###")
+                ok = False
+                self.failures += 1
+                if refused(e):
+                    self.refuse(ids, marks, e)
+                continue
+            with self.lock:
+                self.conn.execute(f'DELETE FROM pending WHERE id IN ({marks})', ids)
+                self.conn.commit()
+            self.flushed += len(batch)
+        return ok
+
+    def refuse(self, ids, marks, error):
+        # only refusals count as attempts, network errors and rate limits are retried until they pass
+        with self.lock:
+            self.conn.execute(f'UPDATE pending SET attempts = attempts + 1 WHERE id IN ({marks})', ids)
+            dead = self.conn.execute(f'SELECT id, target, row FROM pending WHERE id IN ({marks}) AND attempts >= ?',
+                                     ids + [self.max_attempts]).fetchall()
+            self.conn.executemany('INSERT OR REPLACE INTO failed VALUES (?, ?, ?, ?, ?)',
+                                  [(id, target, row, str(error), time.time()) for id, target, row in dead])
+            self.conn.executemany('DELETE FROM pending WHERE id = ?', [(id,) for id, _, _ in dead])
+            self.conn.commit()
+        for id, target, row in dead:
+            print(f"### Sheet journal: row {row} for {target} refused {self.max_attempts} times, moved to failed ###")
+
+    def flusher(self):
+        delay = self.retry_min
+        while True:
+            self.wakeup.wait()
+            # rows written close together, e.g. by several chats, go out in one batch
+            time.sleep(self.batch_wait)
+            self.wakeup.clear()
+            if self.flush():
+                delay = self.retry_min
+            else:
+                time.sleep(delay)
+                delay = min(delay * 2, self.retry_max)
+            if self.pending():
+                self.wakeup.set()
@@ -0,0 +1,87 @@
+import time
+import startup
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+POSTER_URL = "https://image.tmdb.org/t/p/w600_and_h900_bestv2{}"
+THOUGHT_TEMPLATE = "[{}] {}\n{} [[{}]]\n\n"
+
+
+def status_message(tm):
+    status, snapshot = tm.status, tm.snapshot
+    lines = [f"Мыслей в индексе: {len(snapshot.thoughts)}, заметок: {len(snapshot.notes)}"]
+    if status['state'] == 'loading':
+        lines.append(f"Загрузка индекса: {time.time() - status['started']:.1f} с")
+    elif status['state'] == 'reindexing':
+        lines.append(f"Переиндексация: {status['phase']}, {time.time() - status['started']:.1f} с")
+        if status['changed'] or status['deleted']:
+            lines.append(f"Изменено: {status['changed']}, удалено: {status['deleted']}")
+    elif status['duration'] is not None:
+        lines.append(f"Последняя переиндексация: {status['duration']:.1f} с, изменено: {status['changed']}, удалено: {status['deleted']}")
+    lines.append("Запуск:\n" + startup.report())
+    return '\n'.join(lines)
+
+def movie_description(info, movie):
+    return f"{info['название']} ({info['год']})\n{info['режиссер']}\n{movie['overview'][:400]}..."
+
+def thoughts_message(nearest):
+    thoughts = [THOUGHT_TEMPLATE.format(i+1, t, round(float(d), 2), n) \
+                for i, (t, d, n) in enumerate(zip(nearest.thoughts, nearest.distance, nearest.name))]
+    return ''.join(thoughts)
+
+def expense_markup():
+    markup = InlineKeyboardMarkup()
+    markup.row_width = 1
+    markup.add(InlineKeyboardButton("Сохранить", callback_data="save_expense"))
+    return markup
+
+def category_markup(categories):
+    markup = InlineKeyboardMarkup()
+    buttons = [InlineKeyboardButton(c, callback_data='category_' + c) for c in categories]
+    markup.row_width = 2
+    markup.add(*buttons)
+    return markup
+
+def tag_markup(suggested_tags):
+    markup = InlineKeyboardMarkup()
+    buttons = [InlineKeyboardButton('#'+suggested_tags[i], callback_data=f"add_tag_{suggested_tags[i]}") for i in range(len(suggested_tags))]
+    markup.row_width = len(buttons)
+    markup.add(*buttons)
+    return markup
+
+def film_tv_markup():
+    markup = InlineKeyboardMarkup()
+    markup.row_width = 2
+    markup.add(InlineKeyboardButton("Фильм", callback_data="save_movie"),
+               InlineKeyboardButton("Сериал", callback_data="save_tv"))
+    return markup
+
+def check_movie_markup():
+    markup = InlineKeyboardMarkup()
+    markup.row_width = 3
+    markup.add(InlineKeyboardButton("Просмотрено", callback_data="get_rating"),
+               InlineKeyboardButton("На будущее", callback_data="to_watchlist"),
+               InlineKeyboardButton("Следующий", callback_data="another_movie"))
+    return markup
+
+def write_movie_markup():
+    markup = InlineKeyboardMarkup()
+    markup.row_width = 1
+    markup.add(InlineKeyboardButton("Сохранить", callback_data="write_movie"))
+    return markup
+
+def voice_markup():
+    markup = InlineKeyboardMarkup()
+    markup.row_width = 2
+    markup.add(InlineKeyboardButton("В заметки", callback_data="save_note"),
+               InlineKeyboardButton("В фильмы", callback_data="find_film"),
+               InlineKeyboardButton("Мысли", callback_data="get_thoughts"),
+               InlineKeyboardButton("+тэг", callback_data="hashtag"))
+    return markup
+
+def thoughts_markup():
+    markup = InlineKeyboardMarkup()
+    markup.row_width = 5
+    buttons = [InlineKeyboardButton(str(i+1), callback_data=f"add_link_{i}") for i in range(5)] 
+    buttons += [InlineKeyboardButton("Следующие", callback_data="next_thoughts"), InlineKeyboardButton("Сохранить", callback_data="save_note")]
+    markup.add(*buttons)
+    return markup
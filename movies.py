@@ -1,28 +1,44 @@
+import json
 import numpy as np
 import pandas as pd
 import requests
 import tmdbsimple as tmdb
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache
+
+# seconds a TMDb answer is reused; search results change more often than details
+TTL = {'search': 24 * 3600, 'details': 7 * 24 * 3600, 'credits': 7 * 24 * 3600}
+cache = None
+pool = ThreadPoolExecutor(max_workers=4)
+
+def use_cache(path):
+    global cache
+    cache = TTLCache(path)
+
+def cached(kind, key, fetch):
+    if cache is None:
+        return fetch()
+    return cache.get_or_fetch(f'{kind}:{key}', TTL[kind], fetch)
+
+def tmdb_item(film, type):
+    return tmdb.Movies(film['id']) if type == 'movie' else tmdb.TV(film['id'])
 
 def get_movies(name, year=None, language=None, type='movie'):
-    search = tmdb.Search()
-    if type == 'movie':
-        response = search.movie(query=name, year=year, language=language)
-    elif type == 'tv':
-        response = search.tv(query=name, year=year, language=language)
-    else:
+    if type not in {'movie', 'tv'}:
         raise ValueError(f'Unknown type: {type}')
+    def search():
+        if type == 'movie':
+            return tmdb.Search().movie(query=name, year=year, language=language)
+        return tmdb.Search().tv(query=name, year=year, language=language)
+    response = cached('search', json.dumps([type, name, year, language], ensure_ascii=False), search)
     return response['results']
 
 def get_info(film, type='movie'):
-    if type == 'movie':
-        movie = tmdb.Movies(film['id'])
-    else:
-        movie = tmdb.TV(film['id'])
-    info = movie.info()
-    cast = movie.credits()
-    # return movie
+    # details and credits are requested at the same time, each through its own object
+    key = f"{type}:{film['id']}"
+    info = pool.submit(cached, 'details', key, tmdb_item(film, type).info)
+    cast = pool.submit(cached, 'credits', key, tmdb_item(film, type).credits)
+    info, cast = info.result(), cast.result()
 
     director = [m['name'] for m in cast['crew'] if m['job'] == 'Director' or m['job'] == 'Executive Producer']
     producer = [m['name'] for m in cast['crew'] if m['job'] == 'Producer']
@@ -53,15 +69,17 @@ def get_info(film, type='movie'):
 
 columns = ['Your Rating', 'название', 'год', 'дата просмотра', 'дата выхода', 'Type', 'Name', 'Rating', 'TMDb ID', 'IMDb ID', 'режиссер', 'сценарист', 'проюсер', 'актеры', 'студия', 'комментарий']
 class MovieSaver:
-    def __init__(self, cred_path, tmdb_api_key):
+    def __init__(self, sheets, tmdb_api_key, cache_path=None):
         tmdb.API_KEY = tmdb_api_key
         tmdb.REQUESTS_TIMEOUT = (2, 5)
         tmdb.REQUESTS_SESSION = requests.Session()
-        scopes = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-        self.credentials = ServiceAccountCredentials.from_json_keyfile_name(cred_path, scopes) 
+        self.sheets = sheets
+        if cache_path is not None:
+            use_cache(cache_path)
 
-    def save(self, movie, rating, type, comment=None, sheet=0):
-        info = get_info(movie, type)
+    def save(self, movie, rating, type, comment=None, sheet=0, info=None):
+        # `info` is what get_info returned when the movie was shown, saving then needs no TMDb calls
+        info = dict(info) if info is not None else get_info(movie, type)
         info['Your Rating'] = rating
         info['дата просмотра'] = str(pd.Timestamp.today().date())
         if comment is None:
@@ -71,7 +89,5 @@ class MovieSaver:
         self.write_to_gsheet(film_info, sheet)
 
     def write_to_gsheet(self, film_info, sheet_num):
-        file = gspread.authorize(self.credentials) 
-        sheet = file.open('фильмы').worksheets()[sheet_num]
-        write_row_ind = max({len(sheet.col_values(1)), len(sheet.col_values(2))}) + 1
-        sheet.update(f"A{write_row_ind}:P{write_row_ind}", [film_info])
\ No newline at end of file
+        # the next row is the one after the last filled cell of columns A and B
+        self.sheets.write_row('фильмы', sheet_num, 'A', 'P', film_info, count_cols='A:B')
\ No newline at end of file
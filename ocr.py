@@ -0,0 +1,107 @@
+import time
+import queue
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import Future
+import numpy as np
+import cv2
+from inference import Busy
+
+OCRRequest = namedtuple('OCRRequest', ['key', 'image', 'future'])
+
+
+def decode_image(data, max_side=1600):
+    # straight from the downloaded bytes; large photos are downscaled, text stays legible
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Cannot decode image')
+    scale = max_side / max(image.shape[:2])
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+# Recognizes photos on one worker thread. Requests that arrive within `batch_wait` of each
+# other, e.g. the photos of an album, are recognized together, images of equal size in a
+# single readtext_batched call. Results are cached by telegram's file_unique_id, so a
+# forwarded or repeated photo is not recognized again.
+class OCRService:
+    def __init__(self, reader, max_side=1600, threshold=0.35, cache_size=1024, batch_wait=0.05, max_batch=8, max_queue=32):
+        self.reader, self.max_side, self.threshold = reader, max_side, threshold
+        self.cache_size, self.batch_wait, self.max_batch, self.max_queue = cache_size, batch_wait, max_batch, max_queue
+        self.cache, self.pending = OrderedDict(), {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.rejected = 0
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def find(self, key):
+        # future of a cached or already requested photo, None otherwise
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                future = Future()
+                future.set_result(self.cache[key])
+                return future
+            return self.pending.get(key)
+
+    def submit(self, key, load):
+        # future of the photo's text lines; `load()` returns the image bytes and is only called on a miss
+        future = self.find(key)
+        if future is not None:
+            return future
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            if self.queue.qsize() >= self.max_queue:
+                self.rejected += 1
+                raise Busy('ocr')
+            future = self.pending[key] = Future()
+        try:
+            image = decode_image(load(), self.max_side)
+        except Exception as e:
+            self.finish(key, future, error=e)
+            return future
+        self.queue.put(OCRRequest(key, image, future))
+        return future
+
+    def finish(self, key, future, lines=None, error=None):
+        with self.lock:
+            self.pending.pop(key, None)
+            if error is None:
+                self.cache[key] = lines
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        if error is None:
+            future.set_result(lines)
+        else:
+            future.set_exception(error)
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get(timeout=max(0., deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def worker(self):
+        while True:
+            by_shape = defaultdict(list)
+            for request in self.next_batch():
+                by_shape[request.image.shape].append(request)
+            for requests in by_shape.values():
+                try:
+                    if len(requests) == 1:
+                        results = [self.reader.readtext(requests[0].image)]
+                    else:
+                        results = self.reader.readtext_batched([r.image for r in requests])
+                except Exception as e:
+                    for r in requests:
+                        self.finish(r.key, r.future, error=e)
+                    continue
+                for r, result in zip(requests, results):
+                    lines = [text for _, text, confidence in result if len(text) > 1 and confidence > self.threshold]
+                    self.finish(r.key, r.future, lines)
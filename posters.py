@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from movies import get_info
+from markups import POSTER_URL
+
+
+# Posters of the movie candidates. A poster is sent by its TMDb url, telegram downloads it
+# itself; one telegram has seen is sent again by file_id, and one prefetched while the
+# previous candidate was shown is uploaded from memory. Downloads share a pooled session.
+class PosterFetcher:
+    def __init__(self, workers=4, prefetch=3, cache_size=256, timeout=(2, 5)):
+        self.prefetch_count, self.cache_size, self.timeout = prefetch, cache_size, timeout
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='posters')
+        self.cache, self.file_ids = OrderedDict(), OrderedDict()
+        self.lock = threading.Lock()
+
+    def request(self, path):
+        # future of the poster bytes, each poster is downloaded once
+        with self.lock:
+            future = self.cache.get(path)
+            if future is not None:
+                self.cache.move_to_end(path)
+                return future
+            future = self.cache[path] = self.pool.submit(self.download, path)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return future
+
+    def download(self, path):
+        try:
+            response = self.session.get(POSTER_URL.format(path), timeout=self.timeout)
+            response.raise_for_status()
+            return response.content
+        except Exception:
+            with self.lock:
+                self.cache.pop(path, None)
+            raise
+
+    def fetch(self, path):
+        return self.request(path).result()
+
+    def photo(self, path):
+        # what send_photo gets: a file_id, prefetched bytes or the url
+        with self.lock:
+            if path in self.file_ids:
+                return self.file_ids[path]
+            future = self.cache.get(path)
+        if future is not None and future.done() and future.exception() is None:
+            return future.result()
+        return POSTER_URL.format(path)
+
+    def sent(self, path, message):
+        if not message.photo:
+            return
+        with self.lock:
+            self.file_ids[path] = message.photo[-1].file_id
+            while len(self.file_ids) > self.cache_size:
+                self.file_ids.popitem(last=False)
+
+    def prefetch(self, movies, type):
+        # details and posters of the next candidates, while the current one is looked at;
+        # details land in the TMDb cache, so get_info for them does not wait on the network
+        for movie in movies[:self.prefetch_count]:
+            self.pool.submit(get_info, movie, type)
+            if movie.get('poster_path'):
+                self.request(movie['poster_path'])
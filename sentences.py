@@ -0,0 +1,76 @@
+import re
+import os
+import nltk
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def clean(note):
+    # remove zero-links
+    note = re.sub(r'\[.*\]', '', note)
+    # remove tags and headers
+    note = re.sub(r'\#.*\n', '', note)
+    # remove lines
+    note = re.sub('---', ' ', note)
+    # remove **
+    note = re.sub('\*', '', note)
+    
+    return note
+
+def clean_thought(thought):
+    thought = re.sub(r'\(http\S+', '<LINK>', thought)
+    thought = re.sub(r'http\S+', '<LINK>', thought)
+
+    if thought[:2] == '- ':
+        thought = thought[2:]
+
+    if '<LINK>' in thought:
+        linkless = re.sub('<LINK>', '', thought)
+        linkless = re.sub('[^a-zA-Zа-яА-Я ]', '',  linkless)
+        linkless = linkless.strip()
+        if len(linkless.split(' ')) < 2:
+            return ''
+    
+    return thought.strip()
+
+
+def filter_thought(thought):
+    if not thought:
+        return False
+    
+    thought = str(thought)
+    letters_only = re.sub('[^a-zA-Zа-яА-Я]', '',  thought)
+    if len(letters_only) < 10:
+        return False
+    
+    words_only = re.sub('[^a-zA-Zа-яА-Я ]', '',  thought)
+    if len(words_only.split(' ')) < 3:
+        return False
+    
+    return True
+
+
+def get_thoughts(note):
+    thoughts = [t for thought in re.split('\n|\t', note) for t in nltk.sent_tokenize(thought)]
+    cleaned_thoughts = list(map(clean_thought, thoughts))
+    filtered_thoughts = list(filter(filter_thought, cleaned_thoughts))
+    return filtered_thoughts
+
+
+# The pool is started from the watcher thread of a process running torch, faiss and sqlite
+# threads, where forking is unsafe. Its workers come from a forkserver that has this module
+# imported already, or are spawned where there is no forkserver; either way they import
+# only this module and nltk, not torch.
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    mp_context = multiprocessing.get_context('forkserver')
+    mp_context.set_forkserver_preload([__name__])
+else:
+    mp_context = multiprocessing.get_context('spawn')
+
+
+def extract_all_thoughts(notes, workers=None, chunksize=64):
+    # sentence splitting is pure python, so large batches go to a process pool
+    if len(notes) < 2 * chunksize or (os.cpu_count() or 1) <= 1:
+        return list(map(get_thoughts, notes))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+        return list(pool.map(get_thoughts, notes, chunksize=chunksize))
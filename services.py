@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+
+import startup
+from startup import Lazy
+from transcribe import Punctuator
+from finance import SheetWriter
+from movies import MovieSaver
+from sheets import SheetClient, FakeSheetClient
+from journal import SheetJournal
+from thoughts import ThoughtManager
+from threads import set_interop_threads
+from ocr import OCRService
+from posters import PosterFetcher
+startup.mark("modules imported")
+
+# shared by the threaded runtime in bot.py and the asyncio one in async_bot.py
+CONFIG_FOLDER = os.getenv("config")
+config_path = os.path.join(CONFIG_FOLDER, 'var.json')
+with open(config_path, 'r') as f:
+    config = json.load(f)
+    sys.path.append(config['ffprobe'])
+    gsheets_cred = os.path.join(CONFIG_FOLDER, 'gsheets.json')
+    ocr_thr = config.get('ocr_thr', 0.35)
+    # telegram allows about one edit per second in a chat
+    stream_edit_interval = float(config.get('stream_edit_interval', 1.5))
+    session_path = os.path.join(config['cache_path'], 'sessions.sqlite') if config.get('persist_sessions', False) else None
+
+
+def load_ocr():
+    import easyocr
+    return easyocr.Reader(['en', 'ru'])
+
+# models and the categories sheet are loaded on first use, or by the warm-up thread
+set_interop_threads(config.get('torch_interop_threads'))
+if config.get('fake_sheets', False):
+    sheets = FakeSheetClient(latency=float(config.get("fake_sheets_latency", 0.3)),
+                              columns={('финансы', 2): config.get('fake_categories', ['еда'])})
+else:
+    sheets = SheetClient(gsheets_cred, cursor_ttl=float(config.get('sheet_cursor_ttl', 300)))
+# expense and movie rows are acknowledged once stored locally and sent to the sheets in the background
+if config.get('sheet_journal', True):
+    sheets = SheetJournal(os.path.join(config['cache_path'], 'sheet_journal.sqlite'), sheets,
+                          batch_wait=float(config.get('sheet_batch_wait', 1)))
+sheet_writer = Lazy('expense categories', lambda: SheetWriter(sheets, refresh_interval=float(config.get('categories_ttl', 3600))))
+punct = Lazy('punctuator', lambda: Punctuator(config['punct_model'], num_threads=config.get('punct_threads'),
+                                              quantize=config.get('punct_quantize', False)))
+ocr_reader = Lazy('ocr', load_ocr)
+ocr = OCRService(ocr_reader, max_side=int(config.get('ocr_max_side', 1600)), threshold=ocr_thr,
+                 cache_size=int(config.get('ocr_cache_size', 1024)), batch_wait=float(config.get('ocr_batch_wait', 0.05)),
+                 max_queue=int(config.get('ocr_queue', 32)))
+posters = PosterFetcher(workers=int(config.get('poster_workers', 4)), prefetch=int(config.get('poster_prefetch', 3)))
+with startup.phase("opening services"):
+    ms = MovieSaver(sheets, config['tmdb_api_key'], cache_path=os.path.join(config['cache_path'], 'tmdb_cache.sqlite'))
+    # the thought index is loaded in the background, searches wait for it
+    tm = ThoughtManager(config['note_db_path'], model_name=config['embedding_model'], save_path=config['cache_path'],
+                        token_budget=int(config.get('token_budget', 8192)),
+                        cache_size=int(config.get('embedding_cache_size', 200000)),
+                        store_dtype=config.get('store_dtype', 'float32'),
+                        index_params=config.get('index'),
+                        watch_debounce=float(config.get('watch_debounce', 2)),
+                        poll_interval=float(config.get('poll_interval', 60)),
+                        save_delay=float(config.get('index_save_delay', 300)),
+                        num_threads=config.get('embedding_threads'))
+if config.get('warm_up', True):
+    startup.warm_up(punct.get, tm.load_model, ocr_reader.get, sheet_writer.get)
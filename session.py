@@ -0,0 +1,135 @@
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Conversation state of one chat: the note being composed and what the bot waits for.
+class Session:
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.to_delete = []
+        self.suggested_tags = []
+        self.nearest = None
+        self.movies = []
+        self.info = None
+        self.type = None
+        self.reset()
+
+    def __setstate__(self, state):
+        # sessions pickled by an older version get defaults for newer fields
+        self.__init__(state['chat_id'])
+        self.__dict__.update(state)
+
+    def reset(self):
+        self.text = self.text_raw = ''
+        self.movie = self.rating = self.year = self.comment = self.amount = None
+        self.wait_value = None
+        self.tags = []
+        self.links = []
+
+
+# Sessions of recently active chats, least recently used ones are dropped above
+# `max_size` and after `ttl` seconds of inactivity. With `path` they are kept in
+# SQLite as well, so a restart or an eviction does not lose a half-written note.
+# Sessions between acquire() and release() are never dropped.
+class SessionStore:
+    def __init__(self, ttl=86400., max_size=1000, path=None):
+        self.ttl, self.max_size = ttl, max_size
+        self.sessions = OrderedDict()
+        self.pinned = Counter()
+        self.lock = threading.Lock()
+        self.conn = None
+        if path is not None:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS sessions (chat_id TEXT PRIMARY KEY, state BLOB, used REAL)')
+            self.conn.execute('DELETE FROM sessions WHERE used < ?', (time.time() - ttl,))
+            self.conn.commit()
+
+    def get(self, chat_id):
+        now = time.time()
+        with self.lock:
+            entry = self.sessions.pop(chat_id, None)
+            if entry is not None and now - entry[1] > self.ttl and not self.pinned[chat_id]:
+                entry = None
+            if entry is None:
+                entry = (self.load(chat_id, now) or Session(chat_id), now)
+            self.sessions[chat_id] = (entry[0], now)
+            self.evict(now)
+        return entry[0]
+
+    def evict(self, now):
+        idle = [c for c in self.sessions if not self.pinned[c]]
+        overflow = len(self.sessions) - self.max_size
+        for i, chat_id in enumerate(idle):
+            if i >= overflow and now - self.sessions[chat_id][1] <= self.ttl:
+                break
+            del self.sessions[chat_id]
+
+    def acquire(self, chat_id):
+        with self.lock:
+            self.pinned[chat_id] += 1
+        return self.get(chat_id)
+
+    def release(self, session):
+        with self.lock:
+            self.pinned[session.chat_id] -= 1
+            if not self.pinned[session.chat_id]:
+                del self.pinned[session.chat_id]
+            if self.conn is not None:
+                self.conn.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', (str(session.chat_id), pickle.dumps(session), time.time()))
+                self.conn.commit()
+
+    def load(self, chat_id, now):
+        if self.conn is None:
+            return None
+        row = self.conn.execute('SELECT state FROM sessions WHERE chat_id = ? AND used >= ?', (str(chat_id), now - self.ttl)).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception as e:
+            print(f"### Cannot restore session of {chat_id}: {e} ###")
+            return None
+
+
+# Runs tasks on a thread pool, one at a time and in order within a key, keys in parallel.
+class ChatExecutor:
+    def __init__(self, workers=4):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='chat')
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                # the chat is busy, its worker picks the task up when done with the previous ones
+                queue.append((fn, args))
+                return
+            self.queues[key] = deque([(fn, args)])
+        self.pool.submit(self.drain, key)
+
+    def drain(self, key):
+        while True:
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                fn, args = queue.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"### Update of chat {key} failed: {e} ###")
+
+
+def update_chat_id(update):
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return None
@@ -0,0 +1,104 @@
+import time
+import random
+import threading
+from collections import defaultdict
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+
+
+# One authorized gspread client for all writes. The spreadsheet and worksheet handles are
+# opened once and the next free row of a worksheet is kept locally, so a write is a single
+# update request. The row is read from the sheet again after `cursor_ttl` seconds, in case
+# rows were added by hand, and after any failed request.
+class SheetClient:
+    def __init__(self, cred_path, cursor_ttl=300.):
+        self.credentials = ServiceAccountCredentials.from_json_keyfile_name(cred_path, SCOPES)
+        self.cursor_ttl = cursor_ttl
+        self.client, self.spreadsheets, self.worksheets, self.cursors = None, {}, {}, {}
+        self.lock = threading.RLock()
+
+    def authorize(self):
+        # the client refreshes its access token itself; a rejected one rebuilds everything
+        with self.lock:
+            self.client = gspread.authorize(self.credentials)
+            self.spreadsheets, self.worksheets, self.cursors = {}, {}, {}
+
+    def worksheet(self, name, index):
+        with self.lock:
+            if self.client is None:
+                self.authorize()
+            if (name, index) not in self.worksheets:
+                if name not in self.spreadsheets:
+                    self.spreadsheets[name] = self.client.open(name)
+                self.worksheets[(name, index)] = self.spreadsheets[name].get_worksheet(index)
+            return self.worksheets[(name, index)]
+
+    def call(self, fn):
+        try:
+            return fn()
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code != 401:
+                raise
+            self.authorize()
+            return fn()
+
+    def col_values(self, name, index, col):
+        return self.call(lambda: self.worksheet(name, index).col_values(col))
+
+    def next_row(self, name, index, count_cols):
+        # the row after the last filled cell of `count_cols`, e.g. 'A:B'
+        key = (name, index)
+        row, read_at = self.cursors.get(key, (None, 0))
+        if row is None or time.monotonic() - read_at > self.cursor_ttl:
+            row = len(self.worksheet(name, index).get(count_cols)) + 1
+            read_at = time.monotonic()
+        self.cursors[key] = row, read_at
+        return row
+
+    def write_row(self, name, index, first_col, last_col, values, count_cols='A:A'):
+        self.write_rows(name, index, first_col, last_col, [values], count_cols)
+
+    def write_rows(self, name, index, first_col, last_col, rows, count_cols='A:A'):
+        # consecutive rows of one worksheet in a single update request
+        def write():
+            with self.lock:
+                row = self.next_row(name, index, count_cols)
+                try:
+                    self.worksheet(name, index).update(f"{first_col}{row}:{last_col}{row + len(rows) - 1}", rows)
+                except Exception:
+                    self.cursors.pop((name, index), None)
+                    raise
+                self.cursors[(name, index)] = row + len(rows), self.cursors[(name, index)][1]
+        self.call(write)
+
+
+# Keeps worksheets in memory, for running the journal and load tests offline. Every request
+# takes `latency` seconds and fails with probability `fail_rate`.
+class FakeSheetClient:
+    def __init__(self, latency=0.3, fail_rate=0., columns=None):
+        self.latency, self.fail_rate = latency, fail_rate
+        self.columns = columns or {}
+        self.rows = defaultdict(list)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            raise ConnectionError('fake sheets request failed')
+
+    def col_values(self, name, index, col):
+        self.request()
+        return list(self.columns.get((name, index), []))
+
+    def write_row(self, name, index, first_col, last_col, values, count_cols='A:A'):
+        self.write_rows(name, index, first_col, last_col, [values], count_cols)
+
+    def write_rows(self, name, index, first_col, last_col, rows, count_cols='A:A'):
+        self.request()
+        with self.lock:
+            self.rows[(name, index)].extend(rows)
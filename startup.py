@@ -0,0 +1,67 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# seconds since this module was imported, which bot.py does first
+STARTED = time.monotonic()
+timings = []
+first_reply = None
+
+
+def record(name, seconds):
+    timings.append((name, seconds))
+    print(f"### {name}: {seconds:.2f}s ###")
+
+
+@contextmanager
+def phase(name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, time.monotonic() - start)
+
+
+def mark(name):
+    record(f"{name} after", time.monotonic() - STARTED)
+
+
+def mark_first_reply():
+    global first_reply
+    if first_reply is None:
+        first_reply = time.monotonic() - STARTED
+        record("first update handled after", first_reply)
+
+
+def report():
+    return '\n'.join(f"{name}: {seconds:.2f} с" for name, seconds in timings)
+
+
+def warm_up(*loaders):
+    # models are loaded one after another in the background, a request that needs
+    # one earlier loads it itself and the warm-up then finds it ready
+    def run():
+        for load in loaders:
+            try:
+                load()
+            except Exception as e:
+                print(f"### Warm-up failed: {e} ###")
+    threading.Thread(target=run, daemon=True).start()
+
+
+# Builds the wrapped object on first attribute access, once, from any thread.
+class Lazy:
+    def __init__(self, name, factory):
+        self._name, self._factory = name, factory
+        self._value, self._lock = None, threading.Lock()
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    with phase(f"loading {self._name}"):
+                        self._value = self._factory()
+        return self._value
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, path TEXT UNIQUE, name TEXT, tags TEXT, mtime INTEGER, size INTEGER, hash TEXT);
+CREATE TABLE IF NOT EXISTS thoughts (id INTEGER PRIMARY KEY, note_id INTEGER, thought TEXT, deleted INTEGER DEFAULT 0);
+CREATE INDEX IF NOT EXISTS thoughts_note_id ON thoughts (note_id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+
+NoteUpdate = namedtuple('NoteUpdate', ['removed_ids', 'added_ids', 'note_ids', 'deleted_note_ids'])
+
+
+# Notes and thoughts live in SQLite, embeddings in an append-only segment file
+# read through np.memmap. A thought id is its row in the segment. Thoughts of
+# changed or deleted notes are tombstoned and dropped by compact().
+class ThoughtStore:
+    def __init__(self, path, dim, dtype='float32', compact_ratio=0.25):
+        self.path, self.dim, self.dtype, self.compact_ratio = path, dim, np.dtype(dtype), compact_ratio
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(path, 'thoughts.sqlite'), check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+        segment = self.conn.execute("SELECT value FROM meta WHERE key = 'segment'").fetchone()
+        if segment is None:
+            segment = (f'embeddings-0.{self.dtype.name}',)
+            self.conn.execute("INSERT INTO meta VALUES ('segment', ?)", segment)
+            self.conn.commit()
+        # the stored segment keeps its dtype, a changed setting applies to a fresh store
+        self.segment_path, self.dtype = os.path.join(path, segment[0]), np.dtype(segment[0].rsplit('.', 1)[1])
+        self.open_segment()
+
+    def open_segment(self):
+        row_size = self.dim * self.dtype.itemsize
+        if not os.path.exists(self.segment_path):
+            open(self.segment_path, 'wb').close()
+        # rows past the last complete one are leftovers of an interrupted append
+        n_rows = os.path.getsize(self.segment_path) // row_size
+        if os.path.getsize(self.segment_path) != n_rows * row_size:
+            os.truncate(self.segment_path, n_rows * row_size)
+
+        if n_rows > 0:
+            self.embeddings = np.memmap(self.segment_path, dtype=self.dtype, mode='r', shape=(n_rows, self.dim))
+        else:
+            self.embeddings = np.zeros((0, self.dim), dtype=self.dtype)
+
+    def vectors(self, ids):
+        return np.asarray(self.embeddings[np.asarray(ids, dtype=np.int64)], dtype=np.float32)
+
+    def manifest(self):
+        rows = self.conn.execute('SELECT path, mtime, size, hash FROM notes')
+        return {path: {'mtime': mtime, 'size': size, 'hash': note_hash} for path, mtime, size, note_hash in rows}
+
+    def load_notes(self):
+        notes = pd.read_sql_query('SELECT id, name, path, tags FROM notes', self.conn, index_col='id')
+        notes['tags'] = notes.tags.astype('category')
+        return notes.rename_axis(None)
+
+    def load_thoughts(self):
+        thoughts = pd.read_sql_query('SELECT id, note_id, thought FROM thoughts WHERE deleted = 0 ORDER BY id', self.conn, index_col='id')
+        thoughts['note_id'] = thoughts.note_id.astype(np.int32)
+        return thoughts.rename_axis(None)
+
+    def touch_notes(self, manifest):
+        # notes whose stat changed but whose content did not
+        with self.lock:
+            self.conn.executemany('UPDATE notes SET mtime = ?, size = ? WHERE path = ?',
+                                  [(m['mtime'], m['size'], path) for path, m in manifest.items()])
+            self.conn.commit()
+
+    def update_notes(self, notes, embeddings, deleted_paths):
+        # tombstone thoughts of changed and deleted notes, then append the new thoughts
+        # of `notes`; `embeddings` has one row per thought of `notes`, in order
+        with self.lock:
+            first_id = len(self.embeddings)
+            if len(embeddings) > 0:
+                with open(self.segment_path, 'ab') as f:
+                    f.write(np.ascontiguousarray(embeddings, dtype=self.dtype).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            removed_ids = []
+            for path in list(deleted_paths) + [n['path'] for n in notes]:
+                rows = self.conn.execute('SELECT id FROM thoughts WHERE deleted = 0 AND note_id = (SELECT id FROM notes WHERE path = ?)', (path,))
+                removed_ids += [r[0] for r in rows]
+            self.conn.executemany('UPDATE thoughts SET deleted = 1 WHERE id = ?', [(i,) for i in removed_ids])
+            deleted_note_ids = []
+            for path in deleted_paths:
+                deleted_note_ids += [r[0] for r in self.conn.execute('SELECT id FROM notes WHERE path = ?', (path,))]
+            self.conn.executemany('DELETE FROM notes WHERE path = ?', [(p,) for p in deleted_paths])
+
+            thought_rows, note_ids = [], []
+            for n in notes:
+                self.conn.execute('''INSERT INTO notes (path, name, tags, mtime, size, hash) VALUES (?, ?, ?, ?, ?, ?)
+                                     ON CONFLICT (path) DO UPDATE SET name = excluded.name, tags = excluded.tags,
+                                     mtime = excluded.mtime, size = excluded.size, hash = excluded.hash''',
+                                  (n['path'], n['name'], n['tags'], n['mtime'], n['size'], n['hash']))
+                note_id = self.conn.execute('SELECT id FROM notes WHERE path = ?', (n['path'],)).fetchone()[0]
+                note_ids.append(note_id)
+                thought_rows += [(note_id, t) for t in n['thoughts']]
+            self.conn.executemany('INSERT INTO thoughts (id, note_id, thought) VALUES (?, ?, ?)',
+                                  [(first_id + i, note_id, t) for i, (note_id, t) in enumerate(thought_rows)])
+            self.conn.commit()
+            self.open_segment()
+        return NoteUpdate(np.array(removed_ids, dtype=np.int64), np.arange(first_id, first_id + len(thought_rows), dtype=np.int64),
+                          note_ids, deleted_note_ids)
+
+    def tombstone_ratio(self):
+        if len(self.embeddings) == 0:
+            return 0.
+        live = self.conn.execute('SELECT COUNT(*) FROM thoughts WHERE deleted = 0').fetchone()[0]
+        return 1 - live / len(self.embeddings)
+
+    def maybe_compact(self):
+        if self.tombstone_ratio() > self.compact_ratio:
+            self.compact()
+            return True
+        return False
+
+    def compact(self):
+        # live rows are copied to a new segment and renumbered, the segment switch is committed with the ids
+        with self.lock:
+            rows = self.conn.execute('SELECT id, note_id, thought FROM thoughts WHERE deleted = 0 ORDER BY id').fetchall()
+            ids = np.array([r[0] for r in rows], dtype=np.int64)
+
+            generation = int(os.path.basename(self.segment_path).split('-')[1].split('.')[0]) + 1
+            segment = f'embeddings-{generation}.{self.dtype.name}'
+            with open(os.path.join(self.path, segment), 'wb') as f:
+                for i in range(0, len(ids), 65536):
+                    f.write(np.ascontiguousarray(self.embeddings[ids[i:i+65536]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.conn.execute('DELETE FROM thoughts')
+            self.conn.executemany('INSERT INTO thoughts (id, note_id, thought) VALUES (?, ?, ?)',
+                                  [(i, note_id, t) for i, (_, note_id, t) in enumerate(rows)])
+            self.conn.execute("UPDATE meta SET value = ? WHERE key = 'segment'", (segment,))
+            self.conn.commit()
+
+            old_segment, self.segment_path = self.segment_path, os.path.join(self.path, segment)
+            self.open_segment()
+            os.remove(old_segment)
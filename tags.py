@@ -0,0 +1,96 @@
+import os
+import json
+import numpy as np
+
+# on every voice note, not worth suggesting
+DROP_TAGS = {'', 'voice'}
+
+
+def split_tags(tags):
+    return tuple(t for t in dict.fromkeys(str(tags).split(', ')) if t not in DROP_TAGS) if isinstance(tags, str) else ()
+
+
+# Per tag, the sum of the unit embeddings of its thoughts and the number of notes carrying it
+# together with every other tag. Both are updated with the thoughts a reindex adds and removes,
+# so ranking the tags for a text is one (tags x dim) product with the text's embedding.
+class TagIndex:
+    def __init__(self, dim):
+        self.dim = dim
+        self.tags, self.positions = [], {}
+        self.sums = np.zeros((0, dim), dtype=np.float64)
+        self.thought_counts = np.zeros(0, dtype=np.int64)
+        self.cooccurrence = np.zeros((0, 0), dtype=np.int64)
+
+    def copy(self):
+        other = TagIndex(self.dim)
+        other.tags, other.positions = list(self.tags), dict(self.positions)
+        other.sums, other.thought_counts, other.cooccurrence = self.sums.copy(), self.thought_counts.copy(), self.cooccurrence.copy()
+        return other
+
+    def grow(self, tags):
+        new = [t for t in dict.fromkeys(tags) if t not in self.positions]
+        if len(new) == 0:
+            return
+        for tag in new:
+            self.positions[tag] = len(self.tags)
+            self.tags.append(tag)
+        self.sums = np.vstack((self.sums, np.zeros((len(new), self.dim))))
+        self.thought_counts = np.concatenate((self.thought_counts, np.zeros(len(new), dtype=np.int64)))
+        self.cooccurrence = np.pad(self.cooccurrence, ((0, len(new)), (0, len(new))))
+
+    def update(self, note_tags, thought_tags, vectors, sign=1):
+        # `note_tags` holds the tags of each note, `thought_tags` those of each row of `vectors`
+        self.grow(t for tags in note_tags for t in tags)
+        self.grow(t for tags in thought_tags for t in tags)
+        rows = [(self.positions[t], i) for i, tags in enumerate(thought_tags) for t in tags]
+        if len(rows) > 0:
+            positions, thoughts = np.array(rows).T
+            vectors = np.asarray(vectors, dtype=np.float64)
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            np.add.at(self.sums, positions, sign * vectors[thoughts])
+            np.add.at(self.thought_counts, positions, sign)
+        for tags in note_tags:
+            positions = [self.positions[t] for t in tags]
+            self.cooccurrence[np.ix_(positions, positions)] += sign
+
+    def rank(self, queries, chosen=(), k=4, cooccurrence_weight=0.5):
+        # tags closest to the mean of the query embeddings; tags often seen with the
+        # `chosen` ones are moved up by their share of the chosen tags' notes
+        live = self.thought_counts > 0
+        if not live.any():
+            return []
+        query = np.asarray(queries, dtype=np.float64)
+        query = query / np.maximum(np.linalg.norm(query, axis=1, keepdims=True), 1e-12)
+        query = query.mean(axis=0)
+        scores = self.sums @ query / np.maximum(np.linalg.norm(self.sums, axis=1), 1e-12)
+        chosen = [self.positions[t] for t in chosen if t in self.positions]
+        if len(chosen) > 0:
+            notes = np.maximum(np.diag(self.cooccurrence)[chosen].sum(), 1)
+            scores = scores + cooccurrence_weight * self.cooccurrence[chosen].sum(axis=0) / notes
+            live[chosen] = False
+        order = [i for i in np.argsort(-scores, kind='stable') if live[i]]
+        return [self.tags[i] for i in order[:k]]
+
+    def save(self, path, key):
+        # `key` is the one of the thought index saved alongside
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, sums=self.sums, thought_counts=self.thought_counts, cooccurrence=self.cooccurrence)
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump({'key': key, 'tags': self.tags}, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        os.replace(path + '.json.tmp', path + '.json')
+
+    def load(self, path, key):
+        if not os.path.exists(path) or not os.path.exists(path + '.json'):
+            return False
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        if meta['key'] != key:
+            return False
+        with np.load(path) as arrays:
+            if arrays['sums'].shape[1] != self.dim:
+                return False
+            self.sums, self.thought_counts, self.cooccurrence = arrays['sums'], arrays['thought_counts'], arrays['cooccurrence']
+        self.tags = meta['tags']
+        self.positions = {t: i for i, t in enumerate(self.tags)}
+        return True
@@ -1,102 +1,119 @@
 import re
 import os
-import nltk
+import time
+import hashlib
 import numpy as np
 import pandas as pd
-from threading import Timer
-from collections import Counter
+from threading import Lock, Event, Thread
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import torch
-import faiss                 
-from transformers import AutoModel, AutoTokenizer
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+from cache import EmbeddingCache
+from store import ThoughtStore
+from index import VectorIndex
+from tags import TagIndex, split_tags
+from watcher import VaultWatcher
+from threads import torch_threads
+from sentences import clean, get_thoughts, extract_all_thoughts
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-def clean(note):
-    # remove zero-links
-    note = re.sub(r'\[.*\]', '', note)
-    # remove tags and headers
-    note = re.sub(r'\#.*\n', '', note)
-    # remove lines
-    note = re.sub('---', ' ', note)
-    # remove **
-    note = re.sub('\*', '', note)
-    
-    return note
-
-def clean_thought(thought):
-    thought = re.sub(r'\(http\S+', '<LINK>', thought)
-    thought = re.sub(r'http\S+', '<LINK>', thought)
-
-    if thought[:2] == '- ':
-        thought = thought[2:]
-
-    if '<LINK>' in thought:
-        linkless = re.sub('<LINK>', '', thought)
-        linkless = re.sub('[^a-zA-Zа-яА-Я ]', '',  linkless)
-        linkless = linkless.strip()
-        if len(linkless.split(' ')) < 2:
-            return ''
-    
-    return thought.strip()
-
-
-def filter_thought(thought):
-    if not thought:
-        return False
-    
-    thought = str(thought)
-    letters_only = re.sub('[^a-zA-Zа-яА-Я]', '',  thought)
-    if len(letters_only) < 10:
-        return False
-    
-    words_only = re.sub('[^a-zA-Zа-яА-Я ]', '',  thought)
-    if len(words_only.split(' ')) < 3:
-        return False
-    
-    return True
-
-
 def find_tags(note):
     tags = re.findall("\B(\#[a-zA-Z]+(\n|\ ))", note)
     tags = [t.split(s)[0][1:] for (t, s) in tags]
     return tuple(tags)
 
 
-def parse_note_db(db_path, len_thr):
-    path, folders, files = next(os.walk(db_path))
+NOTE_COLUMNS = ['name', 'path', 'note', 'cleaned_note', 'tags']
+
+
+def iter_note_files(db_path):
+    with os.scandir(db_path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_note_files(entry.path)
+            elif '.md' in entry.name:
+                yield entry
+
+
+def scan_note_db(db_path):
+    # stat every markdown file without reading it
+    stats = {}
+    for entry in iter_note_files(db_path):
+        st = entry.stat()
+        stats[entry.path] = (st.st_mtime_ns, st.st_size)
+    return stats
+
+
+def scan_paths(paths):
+    # like scan_note_db, restricted to the given notes and folders
+    stats = {}
+    for path in paths:
+        if os.path.isdir(path):
+            stats.update(scan_note_db(path))
+        elif '.md' in os.path.basename(path) and os.path.isfile(path):
+            st = os.stat(path)
+            stats[path] = (st.st_mtime_ns, st.st_size)
+    return stats
+
+
+def in_scope(path, paths):
+    return path in paths or any(path.startswith(os.path.join(p, '')) for p in paths)
+
+
+def read_note(filepath):
+    with open(filepath, 'r') as f:
+        return f.read()
 
-    note_dfs = []
-    if len(folders) > 0:
-        for f in folders:
-            folder_path = os.path.join(path, f)
-            folder_df = parse_note_db(folder_path, len_thr)
-            note_dfs.append(folder_df)
 
-    db_df = pd.DataFrame()
-    for fn in files:
-        if '.md' not in fn:
-            continue
+def read_notes(paths, workers=8):
+    # yields (path, note) in order with at most 4 * workers reads in flight
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(read_note, path)))
+            if len(pending) >= 4 * workers:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
 
-        filepath = os.path.join(path, fn)
-        with open(filepath, 'r') as f:
-            note = f.read()
 
-        if len(note) < len_thr:
-            continue
-        cleaned_note = clean(note)
-        tags = find_tags(note)
-        note_dict = {'name': fn.split('.md')[0], 'path':filepath, 'note':[note], 'cleaned_note': [cleaned_note], 'tags': ', '.join(tags)}
-        db_df = pd.concat([db_df, pd.DataFrame(note_dict)])
+def hash_note(note):
+    return hashlib.sha1(note.encode('utf-8')).hexdigest()
 
-    note_dfs.append(db_df)
-    res_df = pd.concat(note_dfs)
-    return res_df
 
+def parse_note(filepath, note, len_thr):
+    if len(note) < len_thr:
+        return None
+    cleaned_note = clean(note)
+    tags = find_tags(note)
+    name = os.path.basename(filepath).split('.md')[0]
+    return {'name': name, 'path': filepath, 'note': note, 'cleaned_note': cleaned_note, 'tags': ', '.join(tags)}
 
-def get_thoughts(note):
-    thoughts = [t for thought in re.split('\n|\t', note) for t in nltk.sent_tokenize(thought)]
-    cleaned_thoughts = list(map(clean_thought, thoughts))
-    filtered_thoughts = list(filter(filter_thought, cleaned_thoughts))
-    return filtered_thoughts
+
+def parse_note_db(db_path, len_thr, workers=8):
+    paths = (entry.path for entry in iter_note_files(db_path))
+    records = (parse_note(path, note, len_thr) for path, note in read_notes(paths, workers))
+    return pd.DataFrame([r for r in records if r is not None], columns=NOTE_COLUMNS)
+
+
+def token_batches(lengths, token_budget):
+    # indices sorted by length, split so that batch size * longest length stays within the budget
+    batch = []
+    for i in np.argsort(lengths, kind='stable'):
+        if len(batch) > 0 and (len(batch) + 1) * lengths[i] > token_budget:
+            yield batch
+            batch = []
+        batch.append(i)
+    if len(batch) > 0:
+        yield batch
+
+
+# notes by note id, thoughts (note id, text) by thought id and the vector index over
+# the same thoughts, always replaced together so queries never see a partial update
+Snapshot = namedtuple('Snapshot', ['notes', 'thoughts', 'index', 'tags'])
 
 
 class ThoughtManager:
@@ -104,123 +121,320 @@ class ThoughtManager:
                         model_name='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2',
                         device='cpu',
                         save_path='../saved',
-                        batch_size=32):
-        self.db_path, self.save_path, self.batch_size = db_path, save_path, batch_size
-        self.init_model(model_name, device)
-        self.parse_thoughts()
-        self.start_timer()
-    
-    def parse_thoughts(self):
+                        token_budget=8192,
+                        cache_size=200000,
+                        store_dtype='float32',
+                        index_params=None,
+                        watch_debounce=2.,
+                        poll_interval=60.,
+                        save_delay=300.,
+                        num_threads=None):
+        self.db_path, self.save_path, self.token_budget, self.store_dtype = db_path, save_path, token_budget, store_dtype
+        self.model_name, self.device, self.num_threads, self.save_delay = model_name, device, num_threads, save_delay
+        self.index_params = index_params or {}
+        self.watcher = VaultWatcher(db_path, self.parse_thoughts, watch_debounce, poll_interval)
+        os.makedirs(save_path, exist_ok=True)
+        self.cache = EmbeddingCache(os.path.join(save_path, 'embedding_cache.sqlite'), model_name, cache_size)
+        # the model is loaded on first use, the index in the background; searches wait for the index
+        self.model = self.tokenizer = None
+        self.model_lock, self.tokenizer_lock, self.ready = Lock(), Lock(), Event()
+        self.dim = AutoConfig.from_pretrained(self.model_dir() if os.path.exists(self.model_dir()) else model_name).hidden_size
+        self.load()
+        Thread(target=self.start, daemon=True).start()
+
+    def load(self):
+        self.store = ThoughtStore(self.save_path, self.dim, self.store_dtype)
+        self.reindex_lock = Lock()
+        self.status = {'state': 'loading', 'phase': None, 'started': time.time(), 'duration': None, 'changed': 0, 'deleted': 0}
+        empty_notes = pd.DataFrame({'name': [], 'path': [], 'tags': pd.Categorical([])}, index=pd.Index([], dtype=np.int64))
+        empty_thoughts = pd.DataFrame({'note_id': np.zeros(0, dtype=np.int32), 'thought': np.zeros(0, dtype=object)}, index=pd.Index([], dtype=np.int64))
+        self.snapshot = Snapshot(empty_notes, empty_thoughts, VectorIndex(self.dim, **self.index_params), TagIndex(self.dim))
+        # whether the snapshot covers the whole store; until then only full builds are published
+        self.complete = False
+        self.unsaved = Event()
+
+    def start(self):
+        # searches wait for `ready`, so it is set even if nothing could be loaded
+        started = time.time()
+        try:
+            with self.reindex_lock:
+                try:
+                    self.snapshot = self.load_snapshot()
+                except Exception as e:
+                    # e.g. a truncated index.faiss, the index is rebuilt from the store
+                    print(f"### Cannot load saved index: {e}, rebuilding ###")
+                    self.snapshot = self.build_snapshot()
+                    self.save_index(self.snapshot)
+                self.complete = True
+                print(f"### Loaded {len(self.snapshot.thoughts)} thoughts in {time.time() - started:.2f}s ###")
+        except Exception as e:
+            print(f"### Cannot load thoughts: {e} ###")
+        finally:
+            self.set_status(state='idle', duration=time.time() - started)
+            self.ready.set()
+        Thread(target=self.saver, daemon=True).start()
+        # changes made while the bot was down are picked up by a full rescan
+        self.watcher.start()
+        self.watcher.notify()
+
+    def saver(self):
+        # a reindex only marks the index unsaved, it is written at most once every `save_delay`
+        # seconds; an index older than the store is rebuilt at the next start
+        while True:
+            self.unsaved.wait()
+            time.sleep(self.save_delay)
+            with self.reindex_lock:
+                self.unsaved.clear()
+                self.save_index(self.snapshot)
+
+    def index_key(self):
+        # thought ids only grow and compaction switches the segment, so these identify the indexed vectors
+        segment = os.path.basename(self.store.segment_path)
+        count, last_id = self.store.conn.execute('SELECT COUNT(*), MAX(id) FROM thoughts WHERE deleted = 0').fetchone()
+        return [segment, count, last_id]
+
+    def load_snapshot(self):
+        notes, thoughts = self.store.load_notes(), self.store.load_thoughts()
+        index = VectorIndex(self.dim, **self.index_params)
+        if index.load(os.path.join(self.save_path, 'index.faiss'), self.index_key()):
+            tags = TagIndex(self.dim)
+            if not tags.load(os.path.join(self.save_path, 'tags.npz'), self.index_key()):
+                tags = self.build_tags(notes, thoughts, self.store.vectors(thoughts.index.values))
+            return Snapshot(notes, thoughts, index, tags)
+        print("### Saved index is missing or stale, rebuilding ###")
+        snapshot = self.build_snapshot(notes, thoughts)
+        self.save_index(snapshot)
+        return snapshot
+
+    def build_snapshot(self, notes=None, thoughts=None):
+        if notes is None:
+            notes, thoughts = self.store.load_notes(), self.store.load_thoughts()
+        index, vectors = VectorIndex(self.dim, **self.index_params), self.store.vectors(thoughts.index.values)
+        index.build(thoughts.index.values, vectors)
+        return Snapshot(notes, thoughts, index, self.build_tags(notes, thoughts, vectors))
+
+    def build_tags(self, notes, thoughts, vectors):
+        note_tags = dict(zip(notes.index, map(split_tags, np.asarray(notes['tags'], dtype=object))))
+        tags = TagIndex(self.dim)
+        tags.update(list(note_tags.values()), [note_tags.get(n, ()) for n in thoughts.note_id.values], vectors)
+        return tags
+
+    def save_index(self, snapshot):
+        try:
+            snapshot.index.save(os.path.join(self.save_path, 'index.faiss'), self.index_key())
+            snapshot.tags.save(os.path.join(self.save_path, 'tags.npz'), self.index_key())
+        except Exception as e:
+            print(f"### Cannot save index: {e} ###")
+
+    def set_status(self, **kwargs):
+        self.status = dict(self.status, **kwargs)
+
+    def parse_thoughts(self, paths=None):
+        with self.reindex_lock:
+            started = time.time()
+            self.set_status(state='reindexing', phase='scanning', started=started, changed=0, deleted=0)
+            try:
+                self.reindex(paths)
+            except Exception:
+                # the store may be ahead of the snapshot now, the next reindex builds it in full
+                self.complete = False
+                raise
+            finally:
+                self.set_status(state='idle', phase=None, duration=time.time() - started)
+
+    def reindex(self, paths=None):
+        # the new snapshot is built aside and published with a single assignment;
+        # `paths` limits the scan to the given notes and folders
         print("### Parsing notes ###")
-        parsed = parse_note_db(self.db_path, len_thr=40)
-        parsed = self.extract_thoughts(parsed)
-
-        df_path = os.path.join(self.save_path, 'thoughts.csv')
-        if os.path.exists(df_path):
-            loaded = pd.read_csv(df_path, sep=';')
-            embeddings = np.load(os.path.join(self.save_path, 'embeddings.npy'))
-
-            parsed_paths = set(parsed.path)
-            loaded_paths = set(loaded.path)
-            
-            # drop deleted notes            
-            self.embeddings = embeddings[loaded.path.isin(parsed_paths)]
-            self.note_db = loaded[loaded.path.isin(parsed_paths)]
-
-            new_paths = parsed_paths.difference(loaded_paths)
-            if len(new_paths) > 0:
-                # add new notes
-                new_thoughts = parsed[~parsed.path.isin(loaded_paths)]
-                new_embeddings = self.embed(list(new_thoughts.thoughts.values), self.batch_size)
-
-                self.note_db = pd.concat((self.note_db, new_thoughts))
-                self.embeddings = np.concatenate((self.embeddings, new_embeddings), axis=0)
+        if paths is None:
+            stats, saved = scan_note_db(self.db_path), self.store.manifest()
+        else:
+            stats = scan_paths(paths)
+            saved = {p: entry for p, entry in self.store.manifest().items() if in_scope(p, paths)}
+
+        # only notes with a new mtime/size are read, only notes with a new hash are re-parsed
+        touched, parsed = {}, []
+        to_read = [p for p in stats if p not in saved or (saved[p]['mtime'], saved[p]['size']) != stats[p]]
+        for path, note in read_notes(to_read):
+            mtime, size = stats[path]
+            note_hash = hash_note(note)
+            if path in saved and saved[path]['hash'] == note_hash:
+                touched[path] = {'mtime': mtime, 'size': size}
+                continue
+
+            # short notes are recorded too, so they are not re-read
+            note_dict = parse_note(path, note, len_thr=40) or {'name': os.path.basename(path).split('.md')[0], 'path': path, 'cleaned_note': '', 'tags': ''}
+            parsed.append(dict(note_dict, mtime=mtime, size=size, hash=note_hash))
+
+        if len(touched) > 0:
+            self.store.touch_notes(touched)
+
+        deleted_paths = set(saved).difference(stats)
+        if len(parsed) == 0 and len(deleted_paths) == 0 and self.complete:
+            print("### Notes unchanged ###")
+            return
+
+        print(f"### Reindexing {len(parsed)} changed, {len(deleted_paths)} deleted notes ###")
+        self.set_status(phase='embedding', changed=len(parsed), deleted=len(deleted_paths))
+        thoughts = extract_all_thoughts([n['cleaned_note'] for n in parsed])
+        for note_dict, note_thoughts in zip(parsed, thoughts):
+            note_dict['thoughts'] = note_thoughts
+        embeddings = self.embed([t for note_thoughts in thoughts for t in note_thoughts])
+
+        self.set_status(phase='indexing')
+        update = self.store.update_notes(parsed, embeddings, deleted_paths)
+        snapshot = self.snapshot
+        if self.store.maybe_compact():
+            # compaction renumbers thought ids
+            print("### Compacted thought store ###")
+            snapshot = self.build_snapshot()
+        elif not self.complete:
+            # nothing could be loaded at start, the snapshot is built from the whole store
+            snapshot = self.build_snapshot()
+        elif snapshot.index.needs_rebuild():
+            snapshot = self.build_snapshot()
         else:
-            self.note_db = parsed
-            self.embeddings = self.embed(list(parsed.thoughts.values), self.batch_size)
-        
-        self.create_index(self.embeddings)
-        self.save()
+            changed_notes = pd.DataFrame({'name': [n['name'] for n in parsed],
+                                          'path': [n['path'] for n in parsed],
+                                          'tags': [n['tags'] for n in parsed]}, index=update.note_ids)
+            notes = pd.concat((snapshot.notes.drop(update.deleted_note_ids + update.note_ids, errors='ignore'), changed_notes))
+            notes['tags'] = notes.tags.astype(str).astype('category')
+            added_thoughts = pd.DataFrame({'note_id': np.repeat(update.note_ids, [len(t) for t in thoughts]).astype(np.int32),
+                                           'thought': [t for note_thoughts in thoughts for t in note_thoughts]}, index=update.added_ids)
+            index = snapshot.index.copy()
+            index.remove(update.removed_ids)
+            index.add(update.added_ids, embeddings)
+            # tag statistics lose the old versions of changed and deleted notes and gain the new ones
+            tags = snapshot.tags.copy()
+            old_notes = snapshot.notes.loc[snapshot.notes.index.intersection(update.deleted_note_ids + update.note_ids)]
+            old_tags = dict(zip(old_notes.index, map(split_tags, np.asarray(old_notes['tags'], dtype=object))))
+            tags.update(list(old_tags.values()), [old_tags.get(n, ()) for n in snapshot.thoughts.loc[update.removed_ids].note_id.values],
+                        self.store.vectors(update.removed_ids), sign=-1)
+            new_tags = [split_tags(n['tags']) for n in parsed]
+            tags.update(new_tags, [t for t, note_thoughts in zip(new_tags, thoughts) for _ in note_thoughts], self.store.vectors(update.added_ids))
+            snapshot = Snapshot(notes, pd.concat((snapshot.thoughts.drop(update.removed_ids), added_thoughts)), index, tags)
+            if index.needs_rebuild():
+                snapshot = self.build_snapshot()
+
+        self.snapshot = snapshot
+        if self.complete:
+            self.unsaved.set()
+        self.complete = True
         print("### Finished parsing ###")
 
-    def get_nearest(self, note, k):
+    def query_embeddings(self, note):
+        # the thoughts of a note as get_nearest and suggest_tags search them; after one of
+        # them the other finds the embeddings in the cache
         thoughts = get_thoughts(clean(note))
-        nearest = [self.get_knn(t, k=k) for t in thoughts]
-        if len(nearest) > 0:
-            nearest = pd.concat(nearest)
-        else: 
-            nearest = self.get_knn(clean(note), k=k)
-        return nearest.sort_values('distance')
+        if len(thoughts) == 0:
+            thoughts = [clean(note)]
+        return self.embed(thoughts)
+
+    def get_nearest(self, note, k):
+        # one forward pass and one search for all query thoughts
+        queries = self.query_embeddings(note)
+        self.ready.wait()
+        snapshot = self.snapshot
+        D, I = snapshot.index.search(queries, k)
+        found = I.ravel() >= 0
+        nearest = self.lookup(snapshot, I.ravel()[found], D.ravel()[found])
+        # a note hit by several query thoughts is listed once, with its closest thought
+        return nearest.sort_values('distance', kind='stable').drop_duplicates('path')
 
     def get_knn(self, thought, k=5):
         text_embedding = self.embed([thought])
 
-        D, I = self.index.search(text_embedding, k)
-        nearest = self.note_db.iloc[I[0]].copy()
-        nearest['distance'] = D[0]
-        return nearest
-
-    def create_index(self, emb_matrix):
-        self.index = faiss.IndexFlatL2(self.model.config.hidden_size)
-        self.index.add(emb_matrix)
-  
-    def embed(self, texts, batch_size=32):
-        embeddings = []
-        for i in range(0, len(texts), batch_size):
-            text_batch = texts[i:i+batch_size]
-            tokenized = self.tokenizer.batch_encode_plus(text_batch, return_tensors='pt', padding='max_length', truncation=True)
+        self.ready.wait()
+        snapshot = self.snapshot
+        D, I = snapshot.index.search(text_embedding, k)
+        found = I[0] >= 0
+        return self.lookup(snapshot, I[0][found], D[0][found])
+
+    def lookup(self, snapshot, ids, distances):
+        # note metadata is joined in only for the returned thoughts
+        thoughts = snapshot.thoughts.loc[ids]
+        notes = snapshot.notes.loc[thoughts.note_id.values]
+        return pd.DataFrame({'name': notes['name'].values,
+                             'path': notes['path'].values,
+                             'tags': np.asarray(notes['tags'], dtype=object),
+                             'thoughts': thoughts['thought'].values,
+                             'distance': distances}, index=ids)
+
+    def embed(self, texts):
+        # identical thoughts are looked up in the cache and encoded at most once
+        unique = list(dict.fromkeys(texts))
+        cached = dict(zip(unique, self.cache.get(unique)))
+        missing = [t for t in unique if cached[t] is None]
+        if len(missing) > 0:
+            encoded = self.encode(missing)
+            self.cache.put(missing, encoded)
+            cached.update(zip(missing, encoded))
+
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, t in enumerate(texts):
+            embeddings[i] = cached[t]
+        return embeddings
+
+    def encode(self, texts, token_budget=None):
+        token_budget = token_budget or self.token_budget
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if len(texts) == 0:
+            return embeddings
+        self.load_model()
+
+        # pad each batch only up to its longest thought, batching thoughts of similar length;
+        # a call switches the shared fast tokenizer between these padding settings, which
+        # fails while another thread is tokenizing, so calls take turns
+        with self.tokenizer_lock:
+            lengths = [len(ids) for ids in self.tokenizer(list(texts), truncation=True)['input_ids']]
+        for batch in token_batches(lengths, token_budget):
+            with self.tokenizer_lock:
+                tokenized = self.tokenizer([texts[i] for i in batch], return_tensors='pt', padding=True, truncation=True)
             for t in tokenized:
                 tokenized[t] = tokenized[t].to(self.device)
-            with torch.no_grad():
+            with torch.no_grad(), torch_threads(self.num_threads):
                 encoded = self.model(**tokenized)
-            for bn, states in enumerate(encoded.last_hidden_state):
-                emb = states[tokenized['attention_mask'][bn] == 1].mean(dim=0).cpu().detach()
-                embeddings.append(emb)
+            mask = tokenized['attention_mask'].unsqueeze(-1).to(encoded.last_hidden_state.dtype)
+            pooled = (encoded.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1)
+            embeddings[batch] = pooled.cpu().numpy()
+
+        return embeddings
+
+    def model_dir(self):
+        return os.path.join(self.save_path, 'model')
 
-        return torch.vstack(embeddings)
+    def load_model(self):
+        if self.model is not None:
+            return
+        with self.model_lock:
+            if self.model is None:
+                started = time.time()
+                self.init_model(self.model_name, self.device)
+                print(f"### Embedding model loaded in {time.time() - started:.2f}s ###")
 
     def init_model(self, model_name, device):
-        model_path = os.path.join(self.save_path, 'model.pth')
-        tokenizer_path = os.path.join(self.save_path, 'tokenizer.pth')
-        if os.path.exists(model_path):
+        # kept with save_pretrained as safetensors, which loads without unpickling the model
+        model_dir = self.model_dir()
+        legacy_model_path = os.path.join(self.save_path, 'model.pth')
+        if os.path.exists(model_dir):
             print("### Loading existing model ###")
-            self.tokenizer = torch.load(tokenizer_path)
-            self.model = torch.load(model_path)
+            tokenizer, model = AutoTokenizer.from_pretrained(model_dir), AutoModel.from_pretrained(model_dir)
         else:
-            print("### Downloading model ###")
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            self.model = AutoModel.from_pretrained(model_name)
-            torch.save(self.tokenizer, tokenizer_path)
-            torch.save(self.model, model_path)
-        self.model.eval()
-        self.model.to(device)
-        self.device = device
-
-    def extract_thoughts(self, note_db):
-        thoughts = note_db.cleaned_note.apply(get_thoughts)
-        note_db['thoughts'] = thoughts
-        return note_db.explode('thoughts').dropna(subset=['thoughts'])
-
-    def suggest_tags(self, text):
-        drop_tags = {'', 'voice'}
-        nearest = self.get_knn(text, 10)
-        all_tags = ', '.join(nearest.tags.dropna()).split(', ')
-        all_tags = list(filter(lambda x: x not in drop_tags, all_tags))
-        suggested_tags = [t[0] for t in Counter(all_tags).most_common(4)]
-        return suggested_tags
-    
-    def save(self):
-        if not os.path.exists(self.save_path):
-            os.system(f'mkdir {self.save_path}')
-
-        self.note_db.to_csv(os.path.join(self.save_path, 'thoughts.csv'), sep=';', index=False)
-        np.save(os.path.join(self.save_path, 'embeddings.npy'), self.embeddings)
-    
-    def start_timer(self):
-        class RepeatTimer(Timer):
-            def run(self):
-                while not self.finished.wait(self.interval):
-                    self.function(*self.args, **self.kwargs)
-
-        self.timer = RepeatTimer(1800, self.parse_thoughts)
-        self.timer.start()
\ No newline at end of file
+            if os.path.exists(legacy_model_path):
+                print("### Converting pickled model ###")
+                tokenizer = torch.load(os.path.join(self.save_path, 'tokenizer.pth'))
+                model = torch.load(legacy_model_path)
+            else:
+                print("### Downloading model ###")
+                tokenizer, model = AutoTokenizer.from_pretrained(model_name), AutoModel.from_pretrained(model_name)
+            tokenizer.save_pretrained(model_dir + '.tmp')
+            model.save_pretrained(model_dir + '.tmp', safe_serialization=True)
+            os.replace(model_dir + '.tmp', model_dir)
+        model.eval()
+        self.tokenizer, self.model = tokenizer, model.to(device)
+
+    def suggest_tags(self, text, chosen=(), k=4):
+        # ranked against the per-tag centroids instead of a neighbour search
+        queries = self.query_embeddings(text)
+        self.ready.wait()
+        return self.snapshot.tags.rank(queries, chosen, k)
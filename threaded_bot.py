@@ -0,0 +1,313 @@
+import startup
+import os
+import time
+import random
+import pandas as pd
+
+import telebot
+from transcribe import iter_transcription
+from parse import parse_message
+
+from movies import get_movies, get_info
+from session import SessionStore, ChatExecutor, update_chat_id
+from services import config, stream_edit_interval, session_path, sheet_writer, punct, ms, tm, ocr, posters
+from inference import Busy
+from concurrent.futures import ThreadPoolExecutor
+from markups import (status_message, movie_description, thoughts_message, category_markup, tag_markup,
+                     film_tv_markup, check_movie_markup, write_movie_markup, voice_markup, thoughts_markup)
+
+class NoteBot(telebot.TeleBot):
+    def __init__(self, api_token, note_db_path, admin_chat_id, workers=4, session_ttl=86400., max_sessions=1000, session_path=None):
+        # handlers run inline on the chat executor instead of telebot's own worker pool
+        super().__init__(api_token, threaded=False)
+        self.db_path = note_db_path
+        self.admin_chat_id = admin_chat_id
+        self.lang = "ru-RU"
+        self.sessions = SessionStore(session_ttl, max_sessions, session_path)
+        self.executor = ChatExecutor(workers)
+        self.prefetch = ThreadPoolExecutor(2, thread_name_prefix='prefetch')
+
+    def process_new_updates(self, updates):
+        # updates of one chat are handled in order, different chats in parallel
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            chat_id = update_chat_id(update)
+            if update.message is not None and update.message.photo:
+                # photos of an album arrive together, queueing them ahead lets the ocr worker batch them;
+                # the prefetch threads only download, the handler waits on the shared future
+                self.prefetch.submit(self.request_photo, update.message.photo[-1])
+            self.executor.submit(chat_id, self.process_chat_update, chat_id, update)
+
+    def process_chat_update(self, chat_id, update):
+        if chat_id is None:
+            super().process_new_updates([update])
+            return
+        # the session stays in memory while its handlers run and is stored afterwards
+        session = self.sessions.acquire(chat_id)
+        try:
+            super().process_new_updates([update])
+        finally:
+            self.sessions.release(session)
+        startup.mark_first_reply()
+
+    def session(self, chat_id):
+        return self.sessions.get(chat_id)
+
+    def request_photo(self, photo):
+        # future of the photo's text lines, downloaded only if it is not cached or already being recognized
+        return ocr.submit(photo.file_unique_id, lambda: self.download_file(self.get_file(photo.file_id).file_path))
+
+    def recognize_photo(self, photo):
+        return self.request_photo(photo).result()
+
+    def transcribe_message(self, session, message, progress_message_id=None):
+        # chunks are punctuated as they arrive; with `progress_message_id` the partial
+        # text is shown by editing that message, at most once per stream_edit_interval
+        session.tags = []
+        file_info = self.get_file(message.voice.file_id)
+        voice_file = self.download_file(file_info.file_path)
+
+        raw, punctuated, last_edit = [], [], time.monotonic()
+        for chunk in iter_transcription(voice_file, self.lang, workers=int(config.get("transcribe_workers", 4))):
+            if not chunk:
+                continue
+            raw.append(chunk)
+            punctuated.append(punct.apply(chunk))
+            if progress_message_id is not None and time.monotonic() - last_edit > stream_edit_interval:
+                self.edit_text(session, progress_message_id, ' '.join(punctuated) + ' …')
+                last_edit = time.monotonic()
+        return ' '.join(raw), ' '.join(punctuated)
+
+    def edit_text(self, session, message_id, text, reply_markup=None):
+        try:
+            self.edit_message_text(text, session.chat_id, message_id, reply_markup=reply_markup)
+        except telebot.apihelper.ApiTelegramException as e:
+            print(f'Cannot edit message {message_id}: {e}')
+    
+    def save_text(self, session):
+        note_text, note_name = parse_message(session.text, session.tags, session.links)
+        sv_path = os.path.join(self.db_path, f"voice/{note_name}.md")
+        
+        with open(sv_path, "w") as f:
+            f.write(note_text)
+        self.clear(session)
+        # indexed in the background, searchable once the watcher's debounce has passed
+        tm.watcher.notify(sv_path)
+        
+    def handle_expense(self, session, amount):
+        session.amount = amount
+        session.wait_value = 'comment'
+        msg = self.send_message(session.chat_id, f"Сумма: {amount}\nУкажите категорию", reply_markup=category_markup(sheet_writer.categories))
+        return msg.message_id
+
+    def show_movie(self, session):
+        # the next candidates are prepared while this one is looked at
+        movie = session.movies[0]
+        posters.prefetch(session.movies[1:], session.type)
+        info = session.info = get_info(movie, type=session.type)
+        path, description = movie.pop('poster_path', None), movie_description(info, movie)
+        if path is None:
+            msg = self.send_message(session.chat_id, description, reply_markup=check_movie_markup())
+        else:
+            try:
+                msg = self.send_photo(session.chat_id, posters.photo(path), caption=description, reply_markup=check_movie_markup())
+            except telebot.apihelper.ApiTelegramException:
+                # telegram could not download the url, the poster is uploaded instead
+                msg = self.send_photo(session.chat_id, posters.fetch(path), caption=description, reply_markup=check_movie_markup())
+            posters.sent(path, msg)
+        session.to_delete.append(msg.message_id)
+
+    def find_movies(self, session, call, type):
+        session.type = type
+        session.movies = get_movies(session.text, year=session.year, language='ru', type=type)
+        if len(session.movies) == 0:
+            self.send_message(session.chat_id, "Фильм не найден :(")
+            self.clear(session)
+            self.answer_callback_query(call.id, "Film search ended")
+        else:
+            self.show_movie(session)
+
+    def clear(self, session):
+        session.reset()
+        print(f'Deleting {session.to_delete}')
+        for msg_id in session.to_delete:
+            try:
+                self.delete_message(session.chat_id, msg_id)
+            except Exception:
+                print(f'Cannot delete message {msg_id}')
+        session.to_delete = []
+
+
+bot = NoteBot(config['tg_api_token'], config['note_db_path'], config['admin_chat_id'],
+              workers=int(config.get('update_workers', 4)),
+              session_ttl=float(config.get('session_ttl', 86400)),
+              max_sessions=int(config.get('max_sessions', 1000)),
+              session_path=session_path)
+
+@bot.callback_query_handler(func=lambda call: True)
+def callback_query(call):
+    s = bot.session(call.message.chat.id)
+    if call.data == "save_note":
+        if str(s.chat_id) == str(bot.admin_chat_id):
+            bot.save_text(s)
+            bot.answer_callback_query(call.id, "Note saved")
+        else:
+            bot.answer_callback_query(call.id, "Not available")
+            bot.send_message(bot.admin_chat_id, f"{s.chat_id} пытается сохранить тебе заметку!")
+
+    elif call.data == "find_film":
+        msg = bot.send_message(s.chat_id, "Укажи год, если возможно.", reply_markup=film_tv_markup())
+        s.to_delete.append(msg.message_id)
+        s.year = None
+        s.wait_value = 'year'
+    elif call.data == "save_movie":
+        bot.find_movies(s, call, 'movie')
+    elif call.data == "save_tv":
+        bot.find_movies(s, call, 'tv')
+    elif call.data == "another_movie":
+        bot.delete_message(s.chat_id, s.to_delete[-1])
+        s.movies = s.movies[1:]
+        if len(s.movies) > 0:
+            bot.show_movie(s)
+        else:
+            bot.send_message(s.chat_id, "Фильм не найден :(")
+            bot.clear(s)
+            bot.answer_callback_query(call.id, "Film search ended")
+    elif call.data == "get_rating":
+        msg = bot.send_message(s.chat_id, "Введи оценку от 1 до 10", reply_markup=write_movie_markup())
+        s.to_delete.append(msg.message_id)
+        s.wait_value = 'rating'
+    elif call.data == "write_movie":
+        if str(s.chat_id) == str(bot.admin_chat_id):
+            ms.save(s.movies[0], s.rating, s.type, s.comment, info=s.info)
+        bot.clear(s)
+        bot.answer_callback_query(call.id, "Film saved")
+    elif call.data == "to_watchlist":
+        if str(s.chat_id) == str(bot.admin_chat_id):
+            ms.save(s.movies[0], s.rating, s.type, sheet=1, info=s.info)
+            bot.answer_callback_query(call.id, "Film added to watchlist")
+        bot.clear(s)
+    elif call.data == "hashtag":
+        bot.answer_callback_query(call.id)
+        s.wait_value = "tag"
+        s.suggested_tags = tm.suggest_tags(s.text, s.tags)
+        msg = bot.send_message(s.chat_id, "Введи название тега", reply_markup=tag_markup(s.suggested_tags))
+        s.to_delete.append(msg.message_id)
+    elif call.data.startswith("add_tag_"):
+        tag_name = call.data.split('add_tag_')[1]
+        s.tags.append(tag_name)
+    elif call.data.startswith("add_link_"):
+        link = int(call.data.split('add_link_')[1])
+        s.links.append(s.nearest.name.values[link])
+    elif call.data == "get_thoughts":
+        s.nearest = tm.get_nearest(s.text, k=25)
+        nearest = s.nearest[:5]
+        msg = bot.send_message(s.chat_id, thoughts_message(nearest), reply_markup=thoughts_markup())
+        s.to_delete.append(msg.message_id)
+    elif call.data == "next_thoughts":
+        s.nearest = s.nearest[5:]
+        if len(s.nearest) == 0:
+            msg = bot.send_message(s.chat_id, "Конец")
+            s.to_delete.append(msg.message_id)
+            bot.clear(s)
+        else:
+            nearest = s.nearest[:5]
+            bot.delete_message(s.chat_id, s.to_delete[-1])
+            msg = bot.send_message(s.chat_id, thoughts_message(nearest), reply_markup=thoughts_markup())
+            s.to_delete.append(msg.message_id)
+        
+    elif call.data.startswith("category_"):
+        category = call.data.split('category_')[1]
+        sheet_writer.write_to_gsheet(s.amount, category, s.comment)
+        bot.answer_callback_query(call.id, "Expense saved")
+        bot.clear(s)
+    elif call.data == "clear":
+        bot.clear(s)
+
+
+@bot.message_handler(commands=["start"])
+def start_message(message):
+    s = bot.session(message.chat.id)
+    s.text = ""
+    bot.send_message(message.chat.id, "Привет!")
+
+
+@bot.message_handler(content_types=["voice"])
+def handle_voice(message):
+    s = bot.session(message.chat.id)
+    msg = bot.send_message(message.chat.id, "…")
+    s.to_delete.append(msg.message_id)
+    raw, punctuated = bot.transcribe_message(s, message, msg.message_id)
+    if not punctuated:
+        bot.edit_text(s, msg.message_id, "Не удалось распознать речь")
+        return
+
+    if s.wait_value == 'comment':
+        s.comment = punctuated
+        bot.edit_text(s, msg.message_id, punctuated)
+    else:
+        s.text_raw = s.text
+        s.text_raw += raw + " "
+        s.text += punctuated + " "
+        bot.edit_text(s, msg.message_id, punctuated, reply_markup=voice_markup())
+
+@bot.message_handler(content_types=['photo'])
+def handle_image(message):
+    s = bot.session(message.chat.id)
+    try:
+        lines = bot.recognize_photo(message.photo[-1])
+    except Busy:
+        bot.send_message(message.chat.id, "Бот перегружен, попробуйте позже")
+        return
+    text = '\n'.join(lines)
+    if message.caption:
+        text += '\n\n' + message.caption
+    s.text += text + " "
+
+    msg = bot.send_message(message.chat.id, text, reply_markup=voice_markup())
+    s.to_delete.append(msg.message_id)
+
+@bot.message_handler(content_types=["text"])
+def handle_text(message):
+    s = bot.session(message.chat.id)
+    if message.text.startswith("/clear"):
+        bot.clear(s)
+    elif message.text.startswith("/status"):
+        bot.send_message(message.chat.id, status_message(tm))
+    elif message.text.startswith("/random_number"):
+        bot.send_message(message.chat.id, random.randint(0, 100))
+    elif message.text.startswith("/yes_or_no"):
+        bot.send_message(message.chat.id, random.choice(("yes", "no")))
+    elif s.wait_value == "year":
+        try:
+            s.year = int(message.text)
+        except ValueError:
+            bot.send_message(message.chat.id, "### Error processing year, try again. ###")
+    elif s.wait_value == "rating":
+        try:
+            s.rating = int(message.text)
+            s.wait_value = "comment"
+            bot.send_message(message.chat.id, "Добавь комментарий", reply_markup=write_movie_markup())
+        except ValueError:
+            bot.send_message(message.chat.id, "### Error processing rating, try again. ###")
+
+    elif s.wait_value == "comment":
+        s.comment = message.text
+    elif s.wait_value == "tag":
+        s.tags.append(message.text)
+    else:
+        try:
+            amount = int(message.text)
+            msg_id = bot.handle_expense(s, amount)
+            s.to_delete.append(msg_id)
+            return
+        except ValueError:
+            s.text += message.text + " "
+            msg = bot.send_message(message.chat.id, s.text, reply_markup=voice_markup())
+            s.to_delete.append(msg.message_id)
+    
+
+def main():
+    startup.mark("polling started")
+    bot.infinity_polling()
@@ -0,0 +1,34 @@
+import threading
+import torch
+from contextlib import contextmanager
+
+
+# the thread count is process wide, models with a budget take turns so overlapping
+# requests can not restore each other's setting
+budget_lock = threading.Lock()
+
+
+@contextmanager
+def torch_threads(num_threads=None):
+    # torch's intra-op pool runs with `num_threads` while the block holds the lock and is
+    # restored afterwards; callers keep blocks short, e.g. one embedding batch
+    if num_threads is None:
+        yield
+        return
+    with budget_lock:
+        previous = torch.get_num_threads()
+        torch.set_num_threads(num_threads)
+        try:
+            yield
+        finally:
+            torch.set_num_threads(previous)
+
+
+def set_interop_threads(num_threads=None):
+    # only possible before torch runs its first parallel op
+    if num_threads is None:
+        return
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError as e:
+        print(f"Cannot set torch interop threads: {e}")
@@ -1,32 +1,151 @@
 import sys
+import time
+import hashlib
+import threading
+import subprocess
+import numpy as np
 import torch
 from torch import package
-from speech_recognition import Recognizer, AudioData
-from pydub import AudioSegment
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from speech_recognition import Recognizer, AudioData, UnknownValueError
+from threads import torch_threads, set_interop_threads
 
 # torch.backends.quantized.engine = 'qnnpack'
 
-def transcribe_audio(file_path, language="ru-RU"):
-    rec = Recognizer()
-    sound = AudioSegment.from_ogg(file_path)
-    raw_sound = sound.raw_data
+# A recognizer turns one chunk of mono PCM audio into text; it returns '' for
+# chunks without speech and raises on failures worth retrying.
+class GoogleRecognizer:
+    def __init__(self):
+        self.rec = Recognizer()
 
-    sample_size = 50 * sound.frame_rate * 4
-    sample, raw_sound = raw_sound[:sample_size], raw_sound[sample_size:]
-    audio = AudioData(sample, sample_rate=sound.frame_rate, sample_width=sound.frame_width)
-    transcription = rec.recognize_google(audio, language=language)
+    def recognize(self, frames, sample_rate, sample_width, language):
+        audio = AudioData(frames, sample_rate=sample_rate, sample_width=sample_width)
+        try:
+            return self.rec.recognize_google(audio, language=language)
+        except UnknownValueError:
+            return ''
 
-    while len(raw_sound) > 0:
-        sample, raw_sound = raw_sound[:sample_size], raw_sound[sample_size:]
-        audio = AudioData(sample, sample_rate=sound.frame_rate, sample_width=sound.frame_width)
-        transcription += ' ' + rec.recognize_google(audio, language=language)
-    return transcription
+
+class StubRecognizer:
+    # offline recognizer for tests and benchmarks, with a fixed latency and injectable failures
+    def __init__(self, latency=0., fail_every=0):
+        self.latency, self.fail_every, self.calls = latency, fail_every, 0
+
+    def recognize(self, frames, sample_rate, sample_width, language):
+        self.calls += 1
+        time.sleep(self.latency)
+        if self.fail_every and self.calls % self.fail_every == 0:
+            raise ConnectionError('stub recognizer failure')
+        return f"{len(frames) / sample_width / sample_rate:.1f}s"
+
+
+def find_chunks(samples, frame_rate, chunk_len=50, search_len=10, window_ms=30):
+    # (start, end) sample ranges of at most `chunk_len` seconds, each cut at the quietest
+    # window within the last `search_len` seconds, so words are not split
+    window = max(1, int(frame_rate * window_ms / 1000))
+    n_windows = len(samples) // window
+    energy = np.square(samples[:n_windows * window].astype(np.float32)).reshape(n_windows, window).mean(axis=1)
+
+    # the quietest window is looked for in the second half of a chunk at most, and a chunk
+    # with no window there, or a cut not after its start, is cut at its full length
+    chunk = max(1, int(chunk_len * frame_rate))
+    search = min(int(search_len * frame_rate), chunk // 2)
+    chunks, start = [], 0
+    while len(samples) - start > chunk:
+        lo, hi = (start + chunk - search) // window, (start + chunk) // window
+        cut = (lo + int(np.argmin(energy[lo:hi]))) * window + window // 2 if hi > lo else start + chunk
+        if cut <= start:
+            cut = start + chunk
+        chunks.append((start, cut))
+        start = cut
+    chunks.append((start, len(samples)))
+    return chunks
+
+
+def recognize_chunk(recognizer, frames, sample_rate, sample_width, language, retries=3, backoff=1.):
+    for attempt in range(retries + 1):
+        try:
+            return recognizer.recognize(frames, sample_rate, sample_width, language)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f"Chunk recognition failed ({e}), retrying")
+            time.sleep(backoff * 2 ** attempt)
+
+
+def decode_audio(data, frame_rate=16000):
+    # any audio ffmpeg can read, decoded through pipes to 16-bit mono PCM
+    result = subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', 'pipe:0',
+                             '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(frame_rate), 'pipe:1'],
+                            input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise ValueError(f"Cannot decode audio: {result.stderr.decode(errors='ignore').strip()}")
+    return result.stdout
+
+
+default_recognizer = GoogleRecognizer()
+
+def iter_transcription(audio, language="ru-RU", recognizer=None, workers=4, chunk_len=50, frame_rate=16000):
+    # yields chunk transcripts in order, each as soon as it and all chunks before it are recognized;
+    # `audio` holds the encoded file, e.g. a downloaded telegram voice message
+    recognizer = recognizer or default_recognizer
+    pcm = decode_audio(audio, frame_rate)
+    # both views share the decoded buffer, chunks are slices without copies
+    samples, frames, width = np.frombuffer(pcm, dtype=np.int16), memoryview(pcm), 2
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [pool.submit(recognize_chunk, recognizer, frames[start * width:end * width], frame_rate, width, language)
+                   for start, end in find_chunks(samples, frame_rate, chunk_len)]
+        for future in futures:
+            yield future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def transcribe_audio(audio, language="ru-RU", recognizer=None, workers=4, chunk_len=50, frame_rate=16000):
+    texts = iter_transcription(audio, language, recognizer, workers, chunk_len, frame_rate)
+    return ' '.join(t for t in texts if t)
 
 
 class Punctuator:
-    def __init__(self, MODEL_PATH):
+    def __init__(self, MODEL_PATH, num_threads=None, interop_threads=None, quantize=False, cache_size=4096):
         imp = package.PackageImporter(MODEL_PATH)
         self.model = imp.load_pickle("te_model", "model")
+        self.num_threads, self.cache_size = num_threads, cache_size
+        self.cache, self.lock = OrderedDict(), threading.Lock()
+        set_interop_threads(interop_threads)
+        if quantize:
+            self.quantize()
+
+    def quantize(self):
+        # dynamic int8 quantization of the linear layers, scripted models are left as they are
+        module = getattr(self.model, 'model', None)
+        if not isinstance(module, torch.nn.Module) or isinstance(module, torch.jit.ScriptModule):
+            print("### Punctuation model can not be quantized, using float32 ###")
+            return
+        self.model.model = torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def key(self, text, lang):
+        return hashlib.sha1(f"{lang}\n{text}".encode('utf-8')).hexdigest()
 
     def apply(self, text, lang='ru'):
-        return self.model.enhance_text(text.lower(), lang)        
\ No newline at end of file
+        return self.apply_batch([text], lang)[0]
+
+    def apply_batch(self, texts, lang='ru'):
+        # enhance_text takes one text, so texts not in the cache are punctuated one after
+        # another under a single thread budget; the bots stream chunks through apply()
+        keys = [self.key(t.lower(), lang) for t in texts]
+        with self.lock:
+            missing = {k: t for k, t in zip(keys, texts) if k not in self.cache}
+            if len(missing) > 0:
+                with torch_threads(self.num_threads):
+                    for k, t in missing.items():
+                        self.cache[k] = self.model.enhance_text(t.lower(), lang)
+            for k in keys:
+                self.cache.move_to_end(k)
+            results = [self.cache[k] for k in keys]
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return results
@@ -0,0 +1,102 @@
+import os
+import time
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+WATCH_FLAGS = None if INotify is None else (flags.CLOSE_WRITE | flags.CREATE | flags.DELETE | flags.MOVED_FROM |
+                                            flags.MOVED_TO | flags.DELETE_SELF)
+
+
+# Collects changed vault paths and hands them to `on_change` in debounced batches.
+# Uses inotify when available and falls back to periodic full rescans otherwise.
+# `on_change` receives a set of file/folder paths, or None for a full rescan.
+class VaultWatcher:
+    def __init__(self, db_path, on_change, debounce=2., poll_interval=60.):
+        self.db_path, self.on_change = db_path, on_change
+        self.debounce, self.poll_interval = debounce, poll_interval
+        self.cond = threading.Condition()
+        self.pending, self.full_rescan, self.last_event = set(), False, 0.
+
+    def start(self):
+        threading.Thread(target=self.index_loop, daemon=True).start()
+        if INotify is not None:
+            # watches are in place before start() returns, so no change after it is missed
+            self.inotify, self.folders = INotify(), {}
+            self.watch(self.db_path)
+            threading.Thread(target=self.inotify_loop, daemon=True).start()
+        else:
+            print("### inotify is not available, polling the vault ###")
+            threading.Thread(target=self.poll_loop, daemon=True).start()
+
+    def notify(self, path=None):
+        with self.cond:
+            if path is None:
+                self.full_rescan = True
+            else:
+                self.pending.add(path)
+            self.last_event = time.monotonic()
+            self.cond.notify()
+
+    def index_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.full_rescan:
+                    self.cond.wait()
+                # wait until events have been quiet for `debounce` seconds
+                while (remaining := self.last_event + self.debounce - time.monotonic()) > 0:
+                    self.cond.wait(remaining)
+                paths = None if self.full_rescan else self.pending
+                self.pending, self.full_rescan = set(), False
+            try:
+                self.on_change(paths)
+            except Exception as e:
+                print(f"### Reindexing failed: {e} ###")
+
+    def poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.notify()
+
+    def watch(self, folder):
+        for path, _, _ in os.walk(folder):
+            try:
+                self.folders[self.inotify.add_watch(path, WATCH_FLAGS)] = path
+            except OSError:
+                continue
+
+    def unwatch(self, folder):
+        for wd, path in list(self.folders.items()):
+            if path == folder or path.startswith(os.path.join(folder, '')):
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+                self.folders.pop(wd, None)
+
+    def inotify_loop(self):
+        while True:
+            for event in self.inotify.read():
+                if event.mask & flags.Q_OVERFLOW:
+                    self.notify()
+                    continue
+                folder = self.folders.get(event.wd)
+                if folder is None:
+                    continue
+                if event.mask & (flags.DELETE_SELF | flags.IGNORED):
+                    self.folders.pop(event.wd, None)
+                    continue
+
+                path = os.path.join(folder, event.name)
+                if event.mask & flags.ISDIR:
+                    # a new or moved-in folder may already hold notes, a removed one held some
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        self.watch(path)
+                    elif event.mask & flags.MOVED_FROM:
+                        self.unwatch(path)
+                    self.notify(path)
+                elif '.md' in event.name:
+                    self.notify(path)